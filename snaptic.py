@@ -18,12 +18,46 @@
 __author__ = 'harry@snaptic.com'
 __version__ = '0.4-devel'
 
+import asyncore
+import errno
 import mimetypes
 import base64
+import bisect
+import collections
+import contextlib
+import cPickle as pickle
+import hashlib
 import httplib
+import itertools
+import math
 import os
-import simplejson as json
+import Queue
+import random
+import re
+import select
+# backwards compatible with Python < 2.6
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import socket
+import ssl
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 import sys
+import tempfile
+import threading
+import time
+import warnings
+import weakref
+import zlib
+from StringIO import StringIO
 from urllib import urlencode
 import urlparse
 
@@ -56,6 +90,101 @@ class SnapticError(Exception):
     """Returns HTTP response body used to construct this error."""
     return self.args[2]
 
+def _snaptic_error(error):
+    """
+    Returns:
+        error as a SnapticError, other exceptions are wrapped in one.
+    """
+    if isinstance(error, SnapticError):
+        return error
+    if isinstance(error, (socket.error, httplib.HTTPException)):
+        return SnapticError("Error sending request: %s" % error, None, None)
+    return SnapticError("%s: %s" % (error.__class__.__name__, error), None, None)
+
+JSON_BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+
+json_backend = None
+_json_loads  = None
+
+def _import_json_backend(name, fast_only=False):
+    """
+    Get the loads function of a JSON backend.
+
+    Args:
+        name: one of JSON_BACKENDS.
+        fast_only: refuse simplejson when its C speedups are not compiled in, stdlib json is faster then.
+    Returns:
+        A function decoding a JSON document.
+    Raises:
+        ImportError if the backend is not installed.
+    """
+    if name == 'orjson':
+        import orjson
+        return orjson.loads
+    if name == 'ujson':
+        import ujson
+        return ujson.loads
+    if name == 'simplejson':
+        import simplejson
+        if fast_only and simplejson.scanner.c_make_scanner is None:
+            raise ImportError("simplejson is installed without its C speedups")
+        return simplejson.loads
+    if name == 'json':
+        import json as stdlib_json
+        return stdlib_json.loads
+    raise SnapticError("Unknown JSON backend %r, choose one of %s" % (name, ", ".join(JSON_BACKENDS)))
+
+def set_json_backend(name=None):
+    """
+    Choose the library used to decode API responses. By default the fastest
+    installed one of orjson, ujson, simplejson (with C speedups) and the
+    standard library json is picked at import time; the SNAPTIC_JSON_BACKEND
+    environment variable or this function forces a particular one. Response
+    bodies are handed to the backend as the bytes read from the socket, so
+    backends which decode bytes directly (orjson, ujson) never copy them
+    into a text string first.
+
+       Example usage:
+
+           >>> import snaptic
+           >>> snaptic.set_json_backend('json')
+           'json'
+
+    Args:
+        name: one of JSON_BACKENDS, or None to pick the fastest installed one.
+    Returns:
+        The name of the backend now in use.
+    """
+    global json_backend, _json_loads
+    if name is None:
+        for candidate in JSON_BACKENDS:
+            try:
+                loads = _import_json_backend(candidate, fast_only=True)
+            except ImportError:
+                continue
+            name = candidate
+            break
+    else:
+        try:
+            loads = _import_json_backend(name)
+        except ImportError as e:
+            raise SnapticError("JSON backend %s is not available: %s" % (name, e))
+    json_backend, _json_loads = name, loads
+    return name
+
+set_json_backend(os.environ.get('SNAPTIC_JSON_BACKEND') or None)
+
+def _getstate(self):
+    """
+    Pickle support for the model classes, which have __slots__ and so no __dict__.
+    """
+    return dict((name, getattr(self, name)) for name in self.__slots__
+                if name != '__weakref__' and hasattr(self, name))
+
+def _setstate(self, state):
+    for name, value in state.items():
+        setattr(self, name, value)
+
 class User(object):
     """
     A class representing the User structure used by the Snaptic API.
@@ -67,6 +196,10 @@ class User(object):
        user.email # read only
     """
 
+    __slots__ = ('_id', '_user_name', '_created_at', '_email')
+    __getstate__    = _getstate
+    __setstate__    = _setstate
+
     def __init__(self, id=None, user_name=None, created_at=None, email=None):
         self._id             = id
         self._user_name      = user_name
@@ -89,6 +222,40 @@ class User(object):
     def email(self):
         return self._email
 
+class Tag(object):
+    """
+    A class representing a tag and the number of notes carrying it.
+
+     The Tag class exposes the following properties::
+       tag.name # read only
+       tag.count # read only
+    """
+
+    __slots__ = ('_name', '_count')
+    __getstate__    = _getstate
+    __setstate__    = _setstate
+
+    def __init__(self, name=None, count=0):
+        self._name  = name
+        self._count = count
+
+    def __repr__(self):
+        return "<Tag %r count=%d>" % (self._name, self._count)
+
+    def __eq__(self, other):
+        return isinstance(other, Tag) and (self._name, self._count) == (other._name, other._count)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def count(self):
+        return self._count
+
 #Perhaps I should refactor this into a class hierarchy and subclass for image/sound/etc? -htormey
 class Image(object):
     """
@@ -103,8 +270,14 @@ class Image(object):
         image.height
         image.src
         image.data
+
+    Images are shared between notes which reference the same id and revision_id.
     """
 
+    __slots__ = ('type', 'md5', 'id', 'revision_id', 'width', 'height', 'src', 'data', '__weakref__')
+    __getstate__    = _getstate
+    __setstate__    = _setstate
+
     def __init__(self, type="image", md5=None, id=None, revision_id=None, width=0, height=0, src=None, data=None):
         self.type           = type
         self.md5            = md5
@@ -138,6 +311,11 @@ class Note(object):
         note.dictionary # read only
     """
 
+    __slots__ = ('created_at', 'modified_at', 'reminder_at', 'note_id', 'text', 'summary', 'source',
+                 'source_url', 'user', 'children', 'media', 'tags', 'location')
+    __getstate__    = _getstate
+    __setstate__    = _setstate
+
     def __init__(self, created_at, modified_at, reminder_at, note_id, text,
                  summary, source, source_url, user, children, media = [], tags = [], location = []):
         self.created_at   = created_at
@@ -175,620 +353,4727 @@ class Note(object):
         #Working on adding dates/location/media and other fields to this dictionary. Right now you can just update text. -htormey
         return dict(text=self.text)
 
-class Api(object):
+class LazyNotes(object):
     """
+    A read-only sequence of notes which keeps the decoded JSON records and
+    only builds a Note object when an element is first accessed. Supports
+    len(), indexing, slicing and iteration like the list returned by
+    Api.get_notes(), and filter() to select records before building notes.
+
        Example usage:
 
-           To create an instance of the snaptic.Api class with basic authentication:
+           >>> notes = api.get_notes(lazy=True)
+           >>> recent = notes.filter(lambda record: record['modified_at'] > '2010-03-01')
+           >>> [n.text for n in recent[:2]]
+           ['Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb #food #ice']
+    """
 
-               >>> import snaptic
-               >>> api = snaptic.Api("username", "password")
+    def __init__(self, api, records, notes=None, positions=None):
+        """
+        Args:
+            api: Api used to build notes (and look up the user).
+            records: list of decoded JSON notes, records without an id are skipped.
+            notes: notes already built from records, shared with slices and filters of this sequence.
+            positions: indexes into records making up this sequence, None for all of them.
+        """
+        if notes is None:
+            records = [record for record in records if 'id' in record]
+            notes   = [None] * len(records)
+        if positions is None:
+            positions = range(len(records))
+        self._api       = api
+        self._records   = records
+        self._notes     = notes
+        self._positions = positions
 
-           To fetch all users notes and print an attribute:
+    def __len__(self):
+        return len(self._positions)
 
-               >>> [n.created_at for n in api.notes]
-               ['2010-03-08T17:49:08.850Z', '2010-03-06T20:02:32.501Z', '2010-03-06T01:35:14.851Z', '2010-03-05T04:13:00.616Z', '2010-03-01T00:09:38.566Z', '2010-02-18T04:09:55.471Z', '2010-02-18T02:26:35.990Z', 
-               '2010-02-12T23:28:22.612Z', '2010-02-10T03:06:50.590Z', '2010-02-10T06:02:57.068Z', '2010-02-08T05:14:07.000Z', '2010-02-08T02:28:20.391Z', '2010-02-05T06:57:54.323Z', '2010-02-07T07:26:34.469Z', 
-               '2010-01-25T02:11:24.075Z', '2010-01-24T23:37:07.411Z']
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyNotes(self._api, self._records, self._notes, self._positions[index])
+        position = self._positions[index]
+        note = self._notes[position]
+        if note is None:
+            note = self._notes[position] = self._api._make_note(self._records[position])
+        return note
 
-           To fetch a subset of a users notes use a cursor. To get the first 20 notes and print an attribute:
+    def __iter__(self):
+        for i in xrange(len(self._positions)):
+            yield self[i]
 
-               >>> [n.text for n in api.get_notes_from_cursor(-1)]
-               ['Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb', 'Harry says snaptic is da bomb', 'post number 99', 'post number 98', 
-               'post number 97', 'post number 96', 'post number 95', 'post number 94', 'post number 93', 'post number 92', 'post number 91', 'post number 90', 'post number 89', 'post number 88', 'post number 87', 
-               'post number 86', 'post number 85', 'post number 84']
+    def __repr__(self):
+        built = len([p for p in self._positions if self._notes[p] is not None])
+        return "<LazyNotes %d notes, %d built>" % (len(self._positions), built)
 
-           To get the next 20 notes use cursor 1 (cursor 0 returns all notes in a users account):
+    def record(self, index):
+        """
+        Returns:
+            The decoded JSON record behind the note at index, without building it.
+        """
+        return self._records[self._positions[index]]
 
-               >>> [n.text for n in api.get_notes_from_cursor(1)]
-               ['post number 83', 'post number 82', 'post number 81', 'post number 80', 'post number 79', 'post number 78', 'post number 77', 'post number 76', 'post number 75', 'post number 74', 'post number 73', 
-               'post number 72', 'post number 71', post number 70', 'post number 69', 'post number 68', 'post number 67', 'post number 66', 'post number 65', 'post number 64']
+    def filter(self, predicate):
+        """
+        Select notes by their JSON record without building the rest.
 
-           To post a note:
+        Args:
+            predicate: called with each decoded JSON record, i.e. record['modified_at'].
+        Returns:
+            A LazyNotes of the matching notes.
+        """
+        positions = [p for p in self._positions if predicate(self._records[p])]
+        return LazyNotes(self._api, self._records, self._notes, positions)
 
-               >>> api.post_note("Harry says snaptic is da bomb")
-               {
-                "notes":[
-                    {
-                        "summary":"Harry says snaptic is da bomb",
-                        "user": { 
-                            "user_name":"harry12",
-                            "id":1813083},
-                            "created_at":"2010-04-22T04:19:16.543Z",
-                            "mode":"private",
-                            "modified_at":"2010-04-22T04:19:16.543Z",
-                            "reminder_at":null,
-                            "id":2276722,
-                            "text":"Harry says snaptic is da bomb",
-                            "tags":[],
-                            "source":"3banana",
-                            "location":null,
-                            "source_url":"https://snaptic.com/",
-                            "children":0
-                    }]}
+_JSON_STRUCTURE_RE  = re.compile(r'[{}\[\]"]')
+_JSON_STRING_RE     = re.compile(r'["\\]')
 
-           To delete a note:
+class Page(object):
+    """
+    One cursor page of notes together with its cursor information, as
+    returned by a single request to the Snaptic API.
 
-               >>> id        = api.notes[1].note_id
-               >>> api.delete_note(id)
+     The Page class exposes the following properties::
+       page.cursor_position # read only
+       page.notes # read only
+       page.previous_cursor # read only
+       page.next_cursor # read only
+       page.count # read only
+       page.fetched_at # read only
+    """
 
-           To add an image to the above note
+    __slots__ = ('_cursor_position', '_notes', '_previous_cursor', '_next_cursor', '_count', '_fetched_at')
+    __getstate__    = _getstate
+    __setstate__    = _setstate
 
-               >>> id        = api.notes[1].note_id
-               >>> api.load_image_and_add_to_note_with_id("myimage.jpg", id)
+    def __init__(self, cursor_position, notes, previous_cursor=None, next_cursor=None, count=None, fetched_at=None):
+        self._cursor_position   = cursor_position
+        self._notes             = notes
+        self._previous_cursor   = previous_cursor
+        self._next_cursor       = next_cursor
+        self._count             = count
+        self._fetched_at        = fetched_at or time.time()
 
-           To edit a note:
+    def __len__(self):
+        return len(self._notes)
 
-               >>> n[0].text='Harry says coolio'
-               >>> api.edit_note(n[0])
+    def __iter__(self):
+        return iter(self._notes)
 
-           To download image data from a note:
+    def __repr__(self):
+        return "<Page cursor=%r notes=%d previous=%r next=%r>" % (self._cursor_position, len(self._notes),
+                                                                  self._previous_cursor, self._next_cursor)
 
-              >>> api.notes[1].has_media
-              True
-              >>> id = api.notes[1].note_id
-              >>> d = api.get_image_with_id(id)
-              >>> filename = "/Users/harrytormey/%s.jpg" % id
-              >>> fout = open(filename, "wb")
-              >>> fout.write(d)
-              >>> fout.close()
+    @property
+    def cursor_position(self):
+        return self._cursor_position
 
-           To get a json object of a users tags
+    @property
+    def notes(self):
+        return self._notes
 
-             >>> api.get_tags()
-             {
-             "tags":[
-                {
-                    "name":"food",
-                    "count":"1",
-                },
-                {
-                    "name":"ice",
-                    "count":"1",
-                },
-             ]}
-    """
+    @property
+    def previous_cursor(self):
+        return self._previous_cursor
 
-    API_SERVER                  = "api.snaptic.com"
-    API_VERSION                 = "v1"
-    HTTP_GET                    = "GET"
-    HTTP_POST                   = "POST"
-    HTTP_DELETE                 = "DELETE"
-    API_ENDPOINT_NOTES_JSON     = "/notes.json"
-    API_ENDPOINT_TAGS_JSON      = "/tags/tags.json"
-    API_ENDPOINT_NOTES          = "/notes/"
-    API_ENDPOINT_IMAGES         = "/images/"
-    API_ENDPOINT_IMAGES_VIEW    = "/viewImage.action?viewNodeId="
-    API_ENDPOINT_USER_JSON      = "/user.json"
-    API_ENDPOINT_CURSOR         = "?cursor="
+    @property
+    def next_cursor(self):
+        return self._next_cursor
 
-    def __init__(self, username=None, password=None, url=API_SERVER,
-                 use_ssl=True, port=443, timeout=10, cookie_epass=None):
-        """
-        Args:
-            username: The username of the snaptic account.
-            password: The password of the snaptic account.
-            url: The url of the api server which will handle the http(s) API requests.
-            use_ssl: Use ssl for basic auth or not.
-            port: The port to make http(s) requests on.
-            timeout: number of seconds to wait before giving up on a request.
-        """
-        self._url       = url
-        self._use_ssl   = use_ssl
-        self._port      = port
-        self._timeout   = timeout
-        self._user      = None
-        self._notes     = None
-        self._json      = None
-        if cookie_epass:
-            self.set_credentials(cookie_epass=cookie_epass)
-        else:
-            self.set_credentials(username=username, password=password)
+    @property
+    def count(self):
+        return self._count
 
-    def set_credentials(self, username=None, password=None, cookie_epass=None):
-        """
-        Set username/password or cookie.
+    @property
+    def fetched_at(self):
+        return self._fetched_at
 
-        Args:
-            username: 
-                snaptic username.
-            password: 
-                snaptic password.
-            cookie_epass:
-                snaptic authentication cookie
+    @property
+    def cursor_information(self):
         """
-        if username and password:
-            self._username = username
-            self._password = password
-        elif cookie_epass:
-            self._cookie_epass = cookie_epass
-        else:
-            raise SnapticError("No username/password combination\
-                                or cookie authentication provided")
-
-    def load_image_and_add_to_note_with_id(self, filename, id):
+        A dictionary containing previous_cursor, next_cursor and note count, as returned by get_cursor_information.
         """
-        Load image from filename and append to note.
+        return {"previous_cursor": self._previous_cursor, "next_cursor": self._next_cursor, "count": self._count}
 
-        Args::
+def _iter_json_array(read, key, chunk_size=65536):
+    """
+    Incrementally pull the elements of one array out of a JSON object, i.e.
+    the notes in {"count": 2, "notes": [{...}, {...}]}, without reading the
+    whole document into memory.
 
-            filename: filename of image to load data from.
-            id: id of note to which image will be appended.
-        """
-        try: 
-            fin     = open(filename, 'r')
-            data    = fin.read()
-            self.add_image_to_note_with_id(filename, data, id)
-        except IOError:
-            raise SnapticError("Error reading filename")
+    Args:
+        read: callable returning up to chunk_size more characters of the document, '' at the end.
+        key: key of the array in the top level object.
+        chunk_size: number of characters to read at a time.
+    Returns:
+        A generator of the JSON text of each object in the array.
+    """
+    buf         = ''
+    pos         = 0
+    depth       = 0
+    in_string   = False
+    string_start = None
+    last_key    = None
+    in_array    = False
+    item_start  = None
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            if in_string or depth:
+                raise SnapticError("Truncated JSON document reading '%s'" % key)
+            return
+        #Only keep the part of the buffer still needed: an unfinished item or key
+        keep = pos
+        if item_start is not None:
+            keep = item_start
+        elif string_start is not None:
+            keep = string_start
+        buf = buf[keep:] + chunk
+        pos -= keep
+        if item_start is not None:
+            item_start -= keep
+        if string_start is not None:
+            string_start -= keep
 
-    def add_image_to_note_with_id(self, filename, data, id):
-        """
-        Add image data to note.
+        while True:
+            if in_string:
+                match = _JSON_STRING_RE.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                i = match.start()
+                if buf[i] == '\\':
+                    if i + 1 >= len(buf):
+                        pos = i
+                        break
+                    pos = i + 2
+                    continue
+                in_string = False
+                pos = i + 1
+                if string_start is not None:
+                    last_key     = buf[string_start + 1:i]
+                    string_start = None
+                continue
 
-        Args::
+            match = _JSON_STRUCTURE_RE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            i   = match.start()
+            c   = buf[i]
+            pos = i + 1
+            if c == '"':
+                in_string = True
+                if depth == 1:
+                    string_start = i
+            elif c in '{[':
+                depth += 1
+                if c == '[' and depth == 2 and last_key == key:
+                    in_array = True
+                elif c == '{' and depth == 3 and in_array:
+                    item_start = i
+            else:
+                depth -= 1
+                if depth == 2 and item_start is not None:
+                    yield buf[item_start:pos]
+                    item_start = None
+                elif depth == 1:
+                    in_array = False
 
-            filename: filename of image.
-            data: loaded image data to be appended to note.
-            id: id of note to which image data will be appended.
+class _MultiPartBody(object):
+    """
+    A file-like request body made of strings and open files, read in chunks
+    as it is sent so file contents never have to be held in memory.
+    """
 
-        Returns:
-            The server's response page.
-        """
-        page                = "/" + self.API_VERSION + self.API_ENDPOINT_IMAGES + str(id) +".json"
-        return self._post_multi_part(self._url, page, [("image", filename, data)])
+    def __init__(self, parts):
+        self._parts     = parts
+        self._starts    = []
+        self._length    = 0
+        for part in parts:
+            if hasattr(part, 'read'):
+                start = part.tell()
+                try:
+                    size = os.fstat(part.fileno()).st_size
+                except (AttributeError, IOError, OSError):
+                    part.seek(0, 2)
+                    size = part.tell()
+                    part.seek(start)
+                self._starts.append(start)
+                self._length += size - start
+            else:
+                self._starts.append(0)
+                self._length += len(part)
+        self.seek(0)
 
-    def _post_multi_part(self, host, selector, files):
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
         """
-        Post files to an http host as multipart/form-data.
+        Rewind the body so it can be sent again, only seek(0) is supported.
+        """
+        if offset != 0 or whence != 0:
+            raise IOError("_MultiPartBody can only be rewound to the start")
+        self._index     = 0
+        self._offset    = 0
+        for part, start in zip(self._parts, self._starts):
+            if hasattr(part, 'read'):
+                part.seek(start)
 
-        Args::
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index]
+            if hasattr(part, 'read'):
+                chunk = part.read(size)
+            elif size < 0:
+                chunk = part[self._offset:]
+            else:
+                chunk = part[self._offset:self._offset + size]
+            self._offset += len(chunk)
+            if not chunk or (not hasattr(part, 'read') and self._offset >= len(part)):
+                self._index     += 1
+                self._offset    = 0
+            if chunk:
+                chunks.append(chunk)
+                if size > 0:
+                    size -= len(chunk)
+        return ''.join(chunks)
 
-            host: server to send request to
-            selector: API endpoint to send to the server
-            files: sequence of (name, filename, value) elements for data to be uploaded as files
+class _IdIndex(object):
+    """
+    Items in server order, keyed by id, for write-through caching: adding an
+    item at the front, replacing and deleting one are O(1), and the ordered
+    list is only rebuilt when it is next read.
+    """
 
-        Returns:
-            Return the server's response page.
-        """
-        content_type, body = self._encode_multi_part_form_data(files)
-        handler = httplib.HTTPConnection(host)
-        headers = self._get_auth_headers()
-        h = {
-            'User-Agent': 'INSERT USERAGENTNAME',#Change this to library version? -htormey
-            'Content-Type': content_type
-            }
-        headers.update(h)
-        handler.request(self.HTTP_POST, selector, body, headers)
-        response = handler.getresponse()
-        data     = response.read()
-        handler.close()
-        if response.status != 200:
-            raise SnapticError("Error posting files ", response.status, data)
+    def __init__(self, items, key):
+        self._key       = key
+        self._items     = {}
+        self._order     = []
+        self._front     = []
+        self._list      = items
+        for item in items:
+            item_id = key(item)
+            if item_id not in self._items:
+                self._order.append(item_id)
+            self._items[item_id] = item
 
-    def _encode_multi_part_form_data(self, files):
-        """
-        Encode multi part form data to be posted to server.
+    def __len__(self):
+        return len(self._items)
 
-        Args:
-            Files is a sequence of (name, filename, value) elements for data to be uploaded as files
-        Return:
-            sequence of (content_type, body) ready for httplib.HTTPConnection instance
-        """
-        BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
-        CRLF = '\r\n'
-        L = []
-        for (key, filename, value) in files:
-            L.append('--' + BOUNDARY)
-            L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
-            L.append('Content-Type: %s' % self._get_content_type(filename))
-            L.append('')
-            L.append(value)
-        L.append('--' + BOUNDARY + '--')
-        L.append('')
-        body = CRLF.join(L)
-        content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-        return content_type, body
+    def __contains__(self, item_id):
+        return item_id in self._items
 
-    def _get_content_type(self, filename):
+    def get(self, item_id):
+        return self._items.get(item_id)
+
+    def save(self, item):
         """
-        Attempt to guess mimetype of file.
+        Replace the item with the same id, or add item at the front if it is new.
+        """
+        item_id = self._key(item)
+        if item_id not in self._items:
+            self._front.append(item_id)
+        self._items[item_id]    = item
+        self._list              = None
 
-        Args:
-            filename: filename to be guessed.
+    def remove(self, item_id):
+        """
         Returns:
-            File type or default value.
+            True if an item with item_id was removed.
         """
-        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if self._items.pop(item_id, None) is None:
+            return False
+        self._list = None
+        return True
 
-    def delete_note(self, id):#Change this to just take a note
+    def list(self):
         """
-        Delete a note.
-
-        Args:
-            id: id of note to be deleted.
         Returns:
-            The server's response page.
+            The items in order, newest additions first. The list is shared until the next change.
         """
-        return self._request(self.HTTP_DELETE, id)
+        if self._list is None:
+            seen, order = set(), []
+            for item_id in itertools.chain(reversed(self._front), self._order):
+                if item_id in self._items and item_id not in seen:
+                    seen.add(item_id)
+                    order.append(item_id)
+            self._order, self._front = order, []
+            self._list = [self._items[item_id] for item_id in order]
+        return self._list
+
+class ResponseCache(object):
+    """
+    An in-memory cache of GET responses and their validators (ETag and
+    Last-Modified) which Api uses to make conditional requests. When the
+    server answers 304 Not Modified the cached body is served instead, along
+    with any results already parsed from it. Least recently used entries are
+    dropped once max_entries is reached.
+
+       Example usage:
+
+           >>> api = snaptic.Api("username", "password", cache=snaptic.ResponseCache())
+    """
+
+    def __init__(self, max_entries=256):
+        """
+        Args:
+            max_entries: maximum number of responses to keep.
+        """
+        self._max_entries   = max_entries
+        self._entries       = {}
+        self._tick          = 0
+        self._lock          = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            The cached entry for key, a dictionary with etag, last_modified, body and parsed keys, or None.
+        """
+        self._lock.acquire()
+        try:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            self._tick  += 1
+            item[0]     = self._tick
+            return item[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry):
+        """
+        Store an entry for key, evicting the least recently used entry if the cache is full.
+        """
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            self._entries[key] = [self._tick, entry]
+            if len(self._entries) > self._max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Drop every cached entry.
+        """
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+class PageCache(ResponseCache):
+    """
+    A bounded cache of recently fetched cursor Pages which lets Api.get_page
+    answer repeated navigation without going to the network. Pages are
+    served for at most ttl seconds after they were fetched, and least
+    recently used pages are dropped once max_entries is reached. Api clears
+    it whenever a note is posted, edited or deleted through it.
+
+       Example usage:
+
+           >>> api = snaptic.Api("username", "password", page_cache=snaptic.PageCache(64, ttl=300))
+    """
+
+    def __init__(self, max_entries=32, ttl=60):
+        """
+        Args:
+            max_entries: maximum number of pages to keep.
+            ttl: number of seconds a page is served from the cache after it was fetched.
+        """
+        ResponseCache.__init__(self, max_entries)
+        self._ttl = ttl
+
+    def get(self, key):
+        """
+        Returns:
+            The cached Page for key, or None if there is none or it has expired.
+        """
+        page = ResponseCache.get(self, key)
+        if page is None:
+            return None
+        if time.time() - page.fetched_at > self._ttl:
+            self._lock.acquire()
+            try:
+                self._entries.pop(key, None)
+            finally:
+                self._lock.release()
+            return None
+        return page
+
+class FileResponseCache(ResponseCache):
+    """
+    A ResponseCache which also keeps response bodies and validators on disk,
+    one file per url, so they survive restarts. Parsed results are only kept
+    in memory.
+    """
+
+    def __init__(self, directory, max_entries=256):
+        """
+        Args:
+            directory: directory to store responses in, created if missing.
+            max_entries: maximum number of responses to keep in memory.
+        """
+        ResponseCache.__init__(self, max_entries)
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        entry = ResponseCache.get(self, key)
+        if entry is not None:
+            return entry
+        try:
+            fin = open(self._path(key), 'rb')
+            try:
+                entry = pickle.load(fin)
+            finally:
+                fin.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        entry['parsed'] = {}
+        ResponseCache.set(self, key, entry)
+        return entry
+
+    def set(self, key, entry):
+        ResponseCache.set(self, key, entry)
+        stored = dict(etag=entry['etag'], last_modified=entry['last_modified'], body=entry['body'])
+        fd, tmp = tempfile.mkstemp(dir=self._directory)
+        try:
+            fout = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(stored, fout, 2)
+            finally:
+                fout.close()
+            _rename(tmp, self._path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def clear(self):
+        ResponseCache.clear(self)
+        for name in os.listdir(self._directory):
+            os.remove(os.path.join(self._directory, name))
+
+def _rename(src, dst):
+    """
+    Atomically move src over dst, os.rename can't replace files on Windows.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+class ImageCache(object):
+    """
+    An on-disk cache of image data shared by any number of threads and
+    processes, keyed by what identifies an image's content: its md5, or its
+    id and revision_id. Files are written atomically, each read refreshes a
+    file's modification time, and once the cache grows past max_bytes the
+    least recently used files are evicted.
+
+       Example usage:
+
+           >>> api = snaptic.Api(username, password, image_cache=snaptic.ImageCache("~/.snaptic/images"))
+           >>> image = api.notes[0].media[0]
+           >>> data = api.get_image_with_id(image.id, image.revision_id, image.md5)
+    """
+
+    LOCK_FILE   = ".lock"
+    TEMP_PREFIX = ".tmp"
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, low_water=0.9):
+        """
+        Args:
+            directory: directory to store images in, created if missing.
+            max_bytes: size at which least recently used images are evicted.
+            low_water: fraction of max_bytes eviction trims the cache back to.
+        """
+        directory       = os.path.expanduser(directory)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._low_water = int(max_bytes * low_water)
+        self._lock      = threading.Lock()
+        self._size      = self._scan()[0]
+        self.hits       = 0
+        self.misses     = 0
+
+    @staticmethod
+    def key(md5=None, id=None, revision_id=None):
+        """
+        Returns:
+            The cache key for an image, or None if md5 and revision_id are both
+            unknown, in which case the image's content can't be identified.
+        """
+        if md5:
+            return "md5:%s" % md5
+        if id is not None and revision_id is not None:
+            return "id:%s:%s" % (id, revision_id)
+        return None
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """
+        Returns:
+            The image data stored under key, None if it isn't cached.
+        """
+        path = self._path(key)
+        try:
+            fin = open(path, 'rb')
+            try:
+                data = fin.read()
+            finally:
+                fin.close()
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def set(self, key, data):
+        """
+        Store data under key, evicting least recently used images if the
+        cache is over max_bytes.
+        """
+        if len(data) > self._max_bytes:
+            return
+        path    = self._path(key)
+        fd, tmp = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self._directory)
+        try:
+            fout = os.fdopen(fd, 'wb')
+            try:
+                fout.write(data)
+            finally:
+                fout.close()
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            _rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._lock.acquire()
+        try:
+            self._size += len(data) - replaced
+            over        = self._size > self._max_bytes
+        finally:
+            self._lock.release()
+        if over:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used images until the cache is back at its low
+        water mark, so it isn't scanned again on the next set. Other
+        processes sharing the directory wait while this runs.
+        """
+        self._lock.acquire()
+        try:
+            lock = self._lock_directory()
+            try:
+                size, files = self._scan()
+                files.sort()
+                for mtime, path, length in files:
+                    if size <= self._low_water:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    size -= length
+                self._size = size
+            finally:
+                self._unlock_directory(lock)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            lock = self._lock_directory()
+            try:
+                for mtime, path, length in self._scan()[1]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._size = 0
+            finally:
+                self._unlock_directory(lock)
+        finally:
+            self._lock.release()
+
+    @property
+    def size(self):
+        """
+        Approximate number of bytes stored, images added by other processes
+        are only counted once this one evicts.
+        """
+        return self._size
+
+    def _scan(self):
+        """
+        Returns:
+            The total size and a list of (mtime, path, size) of the cached images.
+        """
+        total, files = 0, []
+        for name in os.listdir(self._directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            total += stat.st_size
+            files.append((stat.st_mtime, path, stat.st_size))
+        return total, files
+
+    def _lock_directory(self):
+        if fcntl is None:
+            return None
+        lock = open(os.path.join(self._directory, self.LOCK_FILE), 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def _unlock_directory(self, lock):
+        if lock is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            lock.close()
+
+class _ContentDecoder(object):
+    """
+    File-like reader over a httplib response which undoes a gzip or deflate
+    Content-Encoding as the body is read, one chunk at a time, so the whole
+    compressed body is never held alongside the decoded one.
+    """
+
+    def __init__(self, response, chunk_size=65536):
+        self._response      = response
+        self._chunk_size    = chunk_size
+        self._buffer        = ''
+        self._eof           = False
+        self.received       = 0
+        encoding = (response.getheader('content-encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = None
+        self._raw_deflate_checked = encoding != 'deflate'
+
+    def _decompress(self, chunk):
+        try:
+            return self._decompressor.decompress(chunk)
+        except zlib.error:
+            if self._raw_deflate_checked:
+                raise
+            #Some servers send deflate without the zlib header
+            self._raw_deflate_checked = True
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(chunk)
+
+    def _fill(self):
+        chunk = self._response.read(self._chunk_size)
+        self.received += len(chunk)
+        try:
+            if chunk:
+                self._buffer += self._decompress(chunk)
+                self._raw_deflate_checked = True
+            else:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+        except zlib.error as e:
+            raise SnapticError("Error decoding %s response: %s"
+                               % (self._response.getheader('content-encoding'), e), self._response.status, None)
+
+    def read(self, size=None):
+        """
+        Read up to size decoded bytes, or the rest of the body if size is None.
+        """
+        if self._decompressor is None:
+            data = self._response.read(size)
+            self.received += len(data)
+            return data
+        if size is None:
+            parts = [self._buffer]
+            self._buffer = ''
+            while not self._eof:
+                self._fill()
+                parts.append(self._buffer)
+                self._buffer = ''
+            return ''.join(parts)
+        while len(self._buffer) < size and not self._eof:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _gzip(data):
+    """
+    gzip compress a string.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class _Histogram(object):
+    """
+    Cumulative histogram with fixed upper bounds, Prometheus style.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum    += value
+        self.count  += 1
+
+    def snapshot(self):
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        buckets.append((float('inf'), self.count))
+        return dict(buckets=buckets, sum=self.sum, count=self.count)
+
+class Metrics(object):
+    """
+    A thread-safe registry of request metrics, kept per endpoint (notes,
+    cursor, user, tags, images, delete): request counts by HTTP status,
+    latency histograms, bytes sent and received, new versus reused
+    connections, and JSON parse time per document type.
+
+    Every Api records into its own Metrics unless one is shared between
+    several instances with Api(metrics=...).
+
+       Example usage:
+
+           >>> api.get_notes()
+           >>> api.metrics.snapshot()['requests']['notes']['status']
+           {200: 1}
+           >>> print api.metrics.prometheus()
+    """
+
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._requests  = {}
+        self._parse     = {}
+
+    def _endpoint(self, endpoint):
+        #Caller must hold self._lock
+        stats = self._requests.get(endpoint)
+        if stats is None:
+            stats = self._requests[endpoint] = dict(status={}, bytes_in=0, bytes_out=0, new=0, reused=0,
+                                                    latency=_Histogram())
+        return stats
+
+    def record_request(self, endpoint, status, seconds, bytes_out, bytes_in):
+        """
+        Record a finished request.
+
+        Args:
+            endpoint: endpoint name, i.e 'notes'.
+            status: HTTP status code, or 'error' if no response was received.
+            seconds: time taken to send the request and read the response.
+            bytes_out: size of the request body.
+            bytes_in: size of the response body.
+        """
+        self._lock.acquire()
+        try:
+            stats = self._endpoint(endpoint)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            stats['bytes_out']      += bytes_out
+            stats['bytes_in']       += bytes_in
+            stats['latency'].observe(seconds)
+        finally:
+            self._lock.release()
+
+    def record_connection(self, endpoint, reused):
+        """
+        Record whether a request went out on a reused keep-alive connection or a new one.
+        """
+        self._lock.acquire()
+        try:
+            stats = self._endpoint(endpoint)
+            if reused:
+                stats['reused'] += 1
+            else:
+                stats['new']    += 1
+        finally:
+            self._lock.release()
+
+    def record_parse(self, document, seconds):
+        """
+        Record time spent decoding a JSON document of a type, i.e 'notes'.
+        """
+        self._lock.acquire()
+        try:
+            histogram = self._parse.get(document)
+            if histogram is None:
+                histogram = self._parse[document] = _Histogram()
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns:
+            A dictionary with 'requests' (per endpoint counts, status, bytes_in,
+            bytes_out, connections and latency histogram) and 'json_parse' (per
+            document histogram) keys.
+        """
+        self._lock.acquire()
+        try:
+            requests = {}
+            for endpoint, stats in self._requests.items():
+                requests[endpoint] = dict(count=stats['latency'].count, status=dict(stats['status']),
+                                          bytes_in=stats['bytes_in'], bytes_out=stats['bytes_out'],
+                                          connections=dict(new=stats['new'], reused=stats['reused']),
+                                          latency=stats['latency'].snapshot())
+            parse = dict((document, histogram.snapshot()) for document, histogram in self._parse.items())
+            return dict(requests=requests, json_parse=parse)
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """
+        Clear all recorded metrics.
+        """
+        self._lock.acquire()
+        try:
+            self._requests.clear()
+            self._parse.clear()
+        finally:
+            self._lock.release()
+
+    def prometheus(self):
+        """
+        Returns:
+            The metrics in Prometheus text exposition format.
+        """
+        snapshot    = self.snapshot()
+        requests    = sorted(snapshot['requests'].items())
+        lines       = []
+
+        def histogram(name, label, value, data):
+            for bound, count in data['buckets']:
+                le = bound == float('inf') and '+Inf' or repr(bound)
+                lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, value, le, count))
+            lines.append('%s_sum{%s="%s"} %r' % (name, label, value, data['sum']))
+            lines.append('%s_count{%s="%s"} %d' % (name, label, value, data['count']))
+
+        lines.append('# HELP snaptic_requests_total Requests made by endpoint and HTTP status.')
+        lines.append('# TYPE snaptic_requests_total counter')
+        for endpoint, stats in requests:
+            for status, count in sorted(stats['status'].items()):
+                lines.append('snaptic_requests_total{endpoint="%s",status="%s"} %d' % (endpoint, status, count))
+        lines.append('# HELP snaptic_request_duration_seconds Request latency by endpoint.')
+        lines.append('# TYPE snaptic_request_duration_seconds histogram')
+        for endpoint, stats in requests:
+            histogram('snaptic_request_duration_seconds', 'endpoint', endpoint, stats['latency'])
+        lines.append('# HELP snaptic_request_bytes_total Body bytes sent and received by endpoint.')
+        lines.append('# TYPE snaptic_request_bytes_total counter')
+        for endpoint, stats in requests:
+            lines.append('snaptic_request_bytes_total{endpoint="%s",direction="out"} %d' % (endpoint, stats['bytes_out']))
+            lines.append('snaptic_request_bytes_total{endpoint="%s",direction="in"} %d' % (endpoint, stats['bytes_in']))
+        lines.append('# HELP snaptic_connections_total Requests sent on new or reused connections by endpoint.')
+        lines.append('# TYPE snaptic_connections_total counter')
+        for endpoint, stats in requests:
+            for kind in ('new', 'reused'):
+                lines.append('snaptic_connections_total{endpoint="%s",connection="%s"} %d'
+                             % (endpoint, kind, stats['connections'][kind]))
+        lines.append('# HELP snaptic_json_parse_seconds JSON decoding time by document type.')
+        lines.append('# TYPE snaptic_json_parse_seconds histogram')
+        for document, data in sorted(snapshot['json_parse'].items()):
+            histogram('snaptic_json_parse_seconds', 'document', document, data)
+        return "\n".join(lines) + "\n"
+
+class RateLimiter(object):
+    """
+    Client-side throttle for requests to the Snaptic API, shareable between
+    Api instances (i.e all accounts of an AccountPool). A token bucket caps
+    the request rate, and an adaptive concurrency limit decides how many
+    requests may be in flight at once: it grows additively, by about one
+    request per round trip, while responses come back fine, and is cut
+    multiplicatively when the server answers 429 or 503, a request fails,
+    or an endpoint's recent latency rises well above its long-run average. A
+    Retry-After header on a throttling response pauses all requests for
+    that long.
+
+       Example usage:
+
+           >>> limiter = snaptic.RateLimiter(rate=20, max_concurrency=16)
+           >>> api = snaptic.Api("username", "password", rate_limiter=limiter)
+           >>> limiter.stats['limit']
+    """
+
+    THROTTLED = (429, 503)
+
+    def __init__(self, rate=None, burst=None, max_concurrency=32, min_concurrency=1, concurrency=None,
+                 latency_tolerance=2.0, decrease=0.5):
+        """
+        Args:
+            rate: requests per second at most, None for no rate limit.
+            burst: number of requests which may be sent at once after an idle spell, defaults to rate.
+            max_concurrency: highest number of requests allowed in flight.
+            min_concurrency: lowest number of requests allowed in flight.
+            concurrency: starting number of requests allowed in flight, defaults to a quarter of max_concurrency.
+            latency_tolerance: cut concurrency when an endpoint's recent latency exceeds its long-run average by this factor.
+            decrease: factor the concurrency limit is multiplied by when backing off.
+        """
+        self._rate          = rate
+        self._burst         = float(burst or max(1, rate or 1))
+        self._tokens        = self._burst
+        self._stamp         = time.time()
+        self._max           = max_concurrency
+        self._min           = min_concurrency
+        self._limit         = float(concurrency or max(min_concurrency, max_concurrency // 4))
+        self._tolerance     = latency_tolerance
+        self._decrease_by   = decrease
+        self._in_flight     = 0
+        self._paused_until  = 0
+        self._last_decrease = 0
+        self._latency       = {}
+        self._throttled     = 0
+        self._cond          = threading.Condition()
+
+    @property
+    def stats(self):
+        """
+        Returns:
+            A dictionary with the current concurrency limit, requests in_flight, available
+            tokens and the number of throttled (429/503) responses seen.
+        """
+        self._cond.acquire()
+        try:
+            self._refill(time.time())
+            return dict(limit=int(self._limit), in_flight=self._in_flight, tokens=self._tokens,
+                        throttled=self._throttled)
+        finally:
+            self._cond.release()
+
+    def _refill(self, now):
+        #Caller must hold self._cond
+        if self._rate is not None:
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def acquire(self, deadline=None):
+        """
+        Block until a request may be sent.
+
+        Args:
+            deadline: time.time() after which to give up waiting, None to wait as long as it takes.
+        Raises:
+            SnapticError if the deadline passes first.
+        """
+        self._cond.acquire()
+        try:
+            while True:
+                now     = time.time()
+                self._refill(now)
+                wait    = None
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._in_flight < int(self._limit):
+                    if self._rate is None or self._tokens >= 1:
+                        if self._rate is not None:
+                            self._tokens -= 1
+                        self._in_flight += 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+                if deadline is not None:
+                    left = deadline - now
+                    if left <= 0:
+                        raise SnapticError("Deadline exceeded waiting for the rate limiter", None, None)
+                    wait = wait is None and left or min(wait, left)
+                self._cond.wait(wait)
+        finally:
+            self._cond.release()
+
+    def release(self, endpoint, status, seconds, retry_after=None):
+        """
+        Report the outcome of a request sent after acquire().
+
+        Args:
+            endpoint: endpoint name the request went to, latencies are compared per endpoint.
+            status: HTTP status code, or 'error' if no response was received.
+            seconds: time the request took.
+            retry_after: seconds the server asked clients to wait before retrying, if any.
+        """
+        self._cond.acquire()
+        try:
+            now = time.time()
+            self._in_flight -= 1
+            if status in self.THROTTLED or status == 'error':
+                if status != 'error':
+                    self._throttled += 1
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                self._back_off(now, endpoint)
+            else:
+                baseline, recent = self._latency.get(endpoint, (seconds, seconds))
+                baseline = 0.99 * baseline + 0.01 * seconds
+                recent   = 0.8 * recent + 0.2 * seconds
+                self._latency[endpoint] = (baseline, recent)
+                if recent > self._tolerance * baseline and recent - baseline > 0.005:
+                    self._back_off(now, endpoint)
+                else:
+                    self._limit = min(self._max, self._limit + 1.0 / self._limit)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _back_off(self, now, endpoint):
+        #Caller must hold self._cond. Cut at most once per round trip, a burst
+        #of failures from requests sent together is one congestion signal.
+        baseline, recent = self._latency.get(endpoint, (0, 0))
+        if now - self._last_decrease < recent:
+            return
+        self._limit         = max(self._min, self._limit * self._decrease_by)
+        self._last_decrease = now
+
+def _retry_after(response):
+    """
+    Seconds a Retry-After header asks for, or None if there is none or it is a date.
+    """
+    value = response.getheader('retry-after')
+    try:
+        return value and float(value) or None
+    except ValueError:
+        return None
+
+class _SingleFlight(object):
+    """
+    Run at most one call per key at a time. Threads asking for a key which
+    is already being fetched wait for that call and share its result, or
+    its exception, instead of making their own.
+    """
+
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Call func, unless a call for key is already in flight.
+
+        Returns:
+            The result of func, from this thread's call or the one in flight.
+        """
+        self._lock.acquire()
+        try:
+            call    = self._calls.get(key)
+            leader  = call is None
+            if leader:
+                call = self._calls[key] = dict(done=threading.Event(), value=None, error=None)
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = func()
+            return call['value']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call['done'].set()
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of keep-alive http(s) connections to a single
+    (host, port, ssl) destination.
+
+    Connections are handed out with get() and must be given back with put()
+    once their response has been read completely. Idle connections older than
+    idle_timeout, or ones the server has asked us to close, are discarded and
+    replaced with fresh ones.
+
+    The ConnectionPool class exposes the following properties::
+
+        pool.stats # read only
+    """
+
+    def __init__(self, host, port, use_ssl=True, timeout=10, maxsize=4, idle_timeout=60):
+        """
+        Args:
+            host: server to connect to.
+            port: port to connect on.
+            use_ssl: use https connections or not.
+            timeout: number of seconds to wait for a socket operation or a free connection.
+            maxsize: maximum number of connections open at once to this destination.
+            idle_timeout: number of seconds an idle connection is kept before being replaced.
+        """
+        self._host          = host
+        self._port          = port
+        self._use_ssl       = use_ssl
+        self._timeout       = timeout
+        self._maxsize       = maxsize
+        self._idle_timeout  = idle_timeout
+        self._idle          = []
+        self._open          = 0
+        self._cond          = threading.Condition()
+        self._stats         = dict(created=0, reused=0, discarded=0, requests=0)
+
+    @property
+    def stats(self):
+        """
+        Returns:
+            A dictionary with connection counters for this pool.
+        """
+        self._cond.acquire()
+        try:
+            stats           = dict(self._stats)
+            stats['idle']   = len(self._idle)
+            stats['in_use'] = self._open - len(self._idle)
+            stats['open']   = self._open
+            return stats
+        finally:
+            self._cond.release()
+
+    def _new_connection(self):
+        if self._use_ssl:
+            handler = httplib.HTTPSConnection
+        else:
+            handler = httplib.HTTPConnection
+
+        # 'timeout' parameter is only available in Python 2.6+
+        if sys.version_info[:2] < (2, 6):
+            return handler(self._host, self._port)
+        return handler(self._host, self._port, timeout=self._timeout)
+
+    def get(self, socket_timeout=None):
+        """
+        Check a connection out of the pool, opening a new one if none are idle.
+        Blocks for up to timeout seconds when maxsize connections are in use.
+
+        Args:
+            socket_timeout: socket timeout to use for this checkout instead of the pool's timeout.
+        Returns:
+            A tuple of (connection, reused).
+        """
+        deadline = time.time() + self._timeout
+        self._cond.acquire()
+        try:
+            while True:
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if time.time() - last_used > self._idle_timeout or self._dropped(conn):
+                        self._close(conn)
+                        continue
+                    self._stats['reused']   += 1
+                    self._stats['requests'] += 1
+                    if socket_timeout is not None:
+                        self._set_timeout(conn, socket_timeout)
+                    return conn, True
+                if self._open < self._maxsize:
+                    self._open              += 1
+                    self._stats['created']  += 1
+                    self._stats['requests'] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SnapticError("Timed out waiting for a connection to %s:%s" % (self._host, self._port))
+                self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+        conn = self._new_connection()
+        if socket_timeout is not None:
+            self._set_timeout(conn, socket_timeout)
+        return conn, False
+
+    def _dropped(self, conn):
+        """
+        True if the server has closed an idle connection, which then reads as ready.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _set_timeout(self, conn, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    def put(self, conn, response=None):
+        """
+        Return a connection to the pool.
+
+        Args:
+            conn: connection previously returned by get().
+            response: the fully read response, used to honour "Connection: close".
+        """
+        self._cond.acquire()
+        try:
+            if conn.sock is None or response is None or response.will_close:
+                self._close(conn)
+            else:
+                if getattr(conn, 'timeout', self._timeout) != self._timeout:
+                    self._set_timeout(conn, self._timeout)
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, conn):
+        """
+        Close a broken connection and release its slot in the pool.
+        """
+        self._cond.acquire()
+        try:
+            self._close(conn)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _close(self, conn):
+        #Caller must hold self._cond
+        self._open                  -= 1
+        self._stats['discarded']    += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        self._cond.acquire()
+        try:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                self._close(conn)
+        finally:
+            self._cond.release()
+
+class Api(object):
+    """
+       Example usage:
+
+           To create an instance of the snaptic.Api class with basic authentication:
+
+               >>> import snaptic
+               >>> api = snaptic.Api("username", "password")
+
+           To fetch all users notes and print an attribute:
+
+               >>> [n.created_at for n in api.notes]
+               ['2010-03-08T17:49:08.850Z', '2010-03-06T20:02:32.501Z', '2010-03-06T01:35:14.851Z', '2010-03-05T04:13:00.616Z', '2010-03-01T00:09:38.566Z', '2010-02-18T04:09:55.471Z', '2010-02-18T02:26:35.990Z', 
+               '2010-02-12T23:28:22.612Z', '2010-02-10T03:06:50.590Z', '2010-02-10T06:02:57.068Z', '2010-02-08T05:14:07.000Z', '2010-02-08T02:28:20.391Z', '2010-02-05T06:57:54.323Z', '2010-02-07T07:26:34.469Z', 
+               '2010-01-25T02:11:24.075Z', '2010-01-24T23:37:07.411Z']
+
+           To fetch a subset of a users notes use a cursor. To get the first 20 notes and print an attribute:
+
+               >>> [n.text for n in api.get_notes_from_cursor(-1)]
+               ['Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb', 'Harry says snaptic is da bomb', 'post number 99', 'post number 98', 
+               'post number 97', 'post number 96', 'post number 95', 'post number 94', 'post number 93', 'post number 92', 'post number 91', 'post number 90', 'post number 89', 'post number 88', 'post number 87', 
+               'post number 86', 'post number 85', 'post number 84']
+
+           To get the next 20 notes use cursor 1 (cursor 0 returns all notes in a users account):
+
+               >>> [n.text for n in api.get_notes_from_cursor(1)]
+               ['post number 83', 'post number 82', 'post number 81', 'post number 80', 'post number 79', 'post number 78', 'post number 77', 'post number 76', 'post number 75', 'post number 74', 'post number 73', 
+               'post number 72', 'post number 71', post number 70', 'post number 69', 'post number 68', 'post number 67', 'post number 66', 'post number 65', 'post number 64']
+
+           To post a note:
+
+               >>> api.post_note("Harry says snaptic is da bomb")
+               {
+                "notes":[
+                    {
+                        "summary":"Harry says snaptic is da bomb",
+                        "user": { 
+                            "user_name":"harry12",
+                            "id":1813083},
+                            "created_at":"2010-04-22T04:19:16.543Z",
+                            "mode":"private",
+                            "modified_at":"2010-04-22T04:19:16.543Z",
+                            "reminder_at":null,
+                            "id":2276722,
+                            "text":"Harry says snaptic is da bomb",
+                            "tags":[],
+                            "source":"3banana",
+                            "location":null,
+                            "source_url":"https://snaptic.com/",
+                            "children":0
+                    }]}
+
+           To delete a note:
+
+               >>> id        = api.notes[1].note_id
+               >>> api.delete_note(id)
+
+           To add an image to the above note
+
+               >>> id        = api.notes[1].note_id
+               >>> api.load_image_and_add_to_note_with_id("myimage.jpg", id)
+
+           To edit a note:
+
+               >>> n[0].text='Harry says coolio'
+               >>> api.edit_note(n[0])
+
+           To download image data from a note:
+
+              >>> api.notes[1].has_media
+              True
+              >>> id = api.notes[1].note_id
+              >>> d = api.get_image_with_id(id)
+              >>> filename = "/Users/harrytormey/%s.jpg" % id
+              >>> fout = open(filename, "wb")
+              >>> fout.write(d)
+              >>> fout.close()
+
+           To get a json object of a users tags
+
+             >>> api.get_tags()
+             {
+             "tags":[
+                {
+                    "name":"food",
+                    "count":"1",
+                },
+                {
+                    "name":"ice",
+                    "count":"1",
+                },
+             ]}
+    """
+
+    API_SERVER                  = "api.snaptic.com"
+    API_VERSION                 = "v1"
+    HTTP_GET                    = "GET"
+    HTTP_POST                   = "POST"
+    HTTP_DELETE                 = "DELETE"
+    API_ENDPOINT_NOTES_JSON     = "/notes.json"
+    API_ENDPOINT_TAGS_JSON      = "/tags/tags.json"
+    API_ENDPOINT_NOTES          = "/notes/"
+    API_ENDPOINT_IMAGES         = "/images/"
+    API_ENDPOINT_IMAGES_VIEW    = "/viewImage.action?viewNodeId="
+    API_ENDPOINT_USER_JSON      = "/user.json"
+    API_ENDPOINT_CURSOR         = "?cursor="
+
+    def __init__(self, username=None, password=None, url=API_SERVER,
+                 use_ssl=True, port=443, timeout=10, cookie_epass=None, pool_size=4,
+                 image_workers=4, image_timeout=None, cache=None, retries=0, backoff=0.1,
+                 hedge_after=None, metrics=None, compression=True, compress_over=None, page_cache=None,
+                 rate_limiter=None, max_age=None, image_cache=None):
+        """
+        Args:
+            username: The username of the snaptic account.
+            password: The password of the snaptic account.
+            url: The url of the api server which will handle the http(s) API requests.
+            use_ssl: Use ssl for basic auth or not.
+            port: The port to make http(s) requests on.
+            timeout: number of seconds to wait before giving up on a request.
+            pool_size: maximum number of keep-alive connections kept per host.
+            image_workers: maximum number of images downloaded at once when parsing notes.
+            image_timeout: number of seconds to wait for each image, defaults to timeout.
+            cache: optional ResponseCache used to make conditional GET requests.
+            retries: number of times to retry a GET failing with a network or server error.
+            backoff: base number of seconds for the jittered exponential backoff between retries.
+            hedge_after: number of seconds after which a slow GET is sent a second time, the
+                         first response to arrive wins. None disables hedging.
+            metrics: Metrics registry to record requests in, shared between instances. Each
+                     Api gets its own by default.
+            compression: ask the server for gzip or deflate compressed responses, which are
+                         decoded transparently.
+            compress_over: gzip note bodies posted to the server which are at least this many
+                           bytes. Only set this for servers which accept Content-Encoding: gzip
+                           requests. None never compresses.
+            page_cache: PageCache holding pages returned by get_page, which may then be served
+                        up to its ttl old. None always fetches pages from the server.
+            rate_limiter: RateLimiter every request waits on, shared between instances. None
+                          sends requests without client-side throttling.
+            max_age: number of seconds the notes and json properties serve their cached copy
+                     before fetching it again. None keeps it until a write makes it stale.
+            image_cache: ImageCache to read image data from before downloading it, shared
+                         between instances and processes. None always downloads.
+        """
+        self._url       = url
+        self._use_ssl   = use_ssl
+        self._port      = port
+        self._timeout   = timeout
+        self._pool_size = pool_size
+        self._image_workers = image_workers
+        self._image_timeout = image_timeout
+        self._cache     = cache
+        self._retries   = retries
+        self._backoff   = backoff
+        self._hedge_after = hedge_after
+        self._compression = compression
+        self._compress_over = compress_over
+        self._pages     = page_cache
+        self._rate_limiter = rate_limiter
+        self._max_age   = max_age
+        self._image_cache = image_cache
+        self._listeners = []
+        self._tag_index = None
+        self._local     = threading.local()
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics    = metrics
+        self._images    = weakref.WeakValueDictionary()
+        self._images_lock = threading.Lock()
+        self._flight    = _SingleFlight()
+        self._shared_strings = {}
+        self._pools     = {}
+        self._pools_lock = threading.Lock()
+        self._user      = None
+        self._notes     = None
+        self._json      = None
+        self._json_records = None
+        self._cache_lock = threading.RLock()
+        self._cache_state = dict(notes=None, json=None)
+        if cookie_epass:
+            self.set_credentials(cookie_epass=cookie_epass)
+        else:
+            self.set_credentials(username=username, password=password)
+
+    def set_credentials(self, username=None, password=None, cookie_epass=None):
+        """
+        Set username/password or cookie.
+
+        Args:
+            username: 
+                snaptic username.
+            password: 
+                snaptic password.
+            cookie_epass:
+                snaptic authentication cookie
+        """
+        if username and password:
+            self._username = username
+            self._password = password
+        elif cookie_epass:
+            self._cookie_epass = cookie_epass
+        else:
+            raise SnapticError("No username/password combination\
+                                or cookie authentication provided")
+
+    def load_image_and_add_to_note_with_id(self, filename, id):
+        """
+        Load image from filename and append to note. The file is streamed to
+        the server in chunks rather than read into memory.
+
+        Args::
+
+            filename: filename of image to load data from, or an open file object, which is
+                      left open.
+            id: id of note to which image will be appended.
+
+        Returns:
+            The server's response page.
+        """
+        owned = not hasattr(filename, 'read')
+        try: 
+            if owned:
+                fin     = open(filename, 'rb')
+            else:
+                fin     = filename
+                filename = getattr(fin, 'name', 'image')
+            try:
+                result = self.add_image_to_note_with_id(filename, fin, id)
+            except:
+                if owned:
+                    fin.close()
+                raise
+        except IOError:
+            raise SnapticError("Error reading filename")
+        if owned:
+            self._close_after(result, fin)
+        return result
+
+    def _close_after(self, result, fin):
+        """
+        Close a file opened for an upload once the request result has been sent.
+        """
+        fin.close()
+
+    def add_image_to_note_with_id(self, filename, data, id):
+        """
+        Add image data to note.
+
+        Args::
+
+            filename: filename of image.
+            data: loaded image data, or a file object opened in binary mode, to be appended to note.
+            id: id of note to which image data will be appended.
+
+        Returns:
+            The server's response page.
+        """
+        page                = "/" + self.API_VERSION + self.API_ENDPOINT_IMAGES + str(id) +".json"
+        return self._post_multi_part(self._url, page, [("image", filename, data)])
+
+    def _post_multi_part(self, host, selector, files):
+        """
+        Post files to an http host as multipart/form-data.
+
+        Args::
+
+            host: server to send request to
+            selector: API endpoint to send to the server
+            files: sequence of (name, filename, value) elements for data to be uploaded as files
+
+        Returns:
+            Return the server's response page.
+        """
+        content_type, body = self._encode_multi_part_form_data(files)
+        h = {
+            'User-Agent': 'INSERT USERAGENTNAME',#Change this to library version? -htormey
+            'Content-Type': content_type,
+            'Content-Length': str(len(body))
+            }
+        response, data = self._basic_auth_request(selector, method=self.HTTP_POST, headers=h, params=body,
+                                                  host=host, port=httplib.HTTP_PORT, use_ssl=False)
+        if response.status != 200:
+            raise SnapticError("Error posting files ", response.status, data)
+        self._uploaded()
+        return data
+
+    def _uploaded(self):
+        """
+        An image upload changes notes in ways the caches can't follow, refetch them on their next read.
+        """
+        self._clear_pages()
+        self._cache_lock.acquire()
+        try:
+            self._mark_stale('notes')
+            self._mark_stale('json')
+        finally:
+            self._cache_lock.release()
+
+    def _encode_multi_part_form_data(self, files):
+        """
+        Encode multi part form data to be posted to server. File values are
+        not read here, the body streams them when it is sent.
+
+        Args:
+            Files is a sequence of (name, filename, value) elements for data to be uploaded as files,
+            value is either a string or a file object.
+        Return:
+            sequence of (content_type, body) where body is a file-like object with a known length,
+            ready for httplib.HTTPConnection instance
+        """
+        BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+        CRLF = '\r\n'
+        L = []
+        for (key, filename, value) in files:
+            L.append(CRLF.join([
+                '--' + BOUNDARY,
+                'Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename),
+                'Content-Type: %s' % self._get_content_type(filename),
+                '',
+                '']))
+            L.append(value)
+            L.append(CRLF)
+        L.append('--' + BOUNDARY + '--' + CRLF)
+        body = _MultiPartBody(L)
+        content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
+        return content_type, body
+
+    def _get_content_type(self, filename):
+        """
+        Attempt to guess mimetype of file.
+
+        Args:
+            filename: filename to be guessed.
+        Returns:
+            File type or default value.
+        """
+        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    def delete_note(self, id):#Change this to just take a note
+        """
+        Delete a note.
+
+        Args:
+            id: id of note to be deleted.
+        Returns:
+            The server's response page.
+        """
+        return self._request(self.HTTP_DELETE, id)
 
     def edit_note(self, note):
         """
-        Edit a note.
+        Edit a note.
+
+        Args:
+            note: note object to be edited
+        Returns:
+            The server's response page.
+        """
+        return self._request(self.HTTP_POST, note)
+
+    def post_note(self, note):
+        """
+        Post a note.
+
+        Args:
+            note: text of note to be posted.
+        Returns:
+            The server's response page.
+        """
+        return self._request(self.HTTP_POST, note) #change this to note_text to be a little clearer -htormey
+
+    def post_notes(self, notes, workers=None):
+        """
+        Post several notes concurrently.
+
+        Args:
+            notes: iterable of note texts to be posted.
+            workers: maximum number of requests in flight, defaults to the connection pool size.
+        Returns:
+            A list with, for each note in order, the server's response page or the SnapticError it failed with.
+        """
+        return self._bulk(self.post_note, notes, workers)
+
+    def edit_notes(self, notes, workers=None):
+        """
+        Edit several notes concurrently.
+
+        Args:
+            notes: iterable of note objects to be edited.
+            workers: maximum number of requests in flight, defaults to the connection pool size.
+        Returns:
+            A list with, for each note in order, the server's response page or the SnapticError it failed with.
+        """
+        return self._bulk(self.edit_note, notes, workers)
+
+    def delete_notes(self, ids, workers=None):
+        """
+        Delete several notes concurrently.
+
+        Args:
+            ids: iterable of ids of notes to be deleted.
+            workers: maximum number of requests in flight, defaults to the connection pool size.
+        Returns:
+            A list with, for each id in order, the server's response page or the SnapticError it failed with.
+        """
+        return self._bulk(self.delete_note, ids, workers)
+
+    def _bulk(self, func, items, workers=None):
+        """
+        Call func on every item from a bounded set of threads sharing the
+        Api's keep-alive connections. A failing item doesn't stop the others.
+
+        Returns:
+            A list of func's results, or the SnapticError raised, in the order of items.
+        """
+        items   = list(items)
+        results = [None] * len(items)
+        todo    = Queue.Queue()
+        for i, item in enumerate(items):
+            todo.put((i, item))
+
+        def worker():
+            while True:
+                try:
+                    i, item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception as e:
+                    results[i] = _snaptic_error(e)
+
+        threads = [threading.Thread(target=self._in_thread(worker)) for i in range(min(workers or self._pool_size, len(items)))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def write_behind(self, delay=1.0, retries=3):
+        """
+        Get a WriteBehindQueue which sends post_note, edit_note and delete_note
+        calls from a background thread, merging repeated edits of a note.
+
+        Args:
+            delay: number of seconds to hold writes before sending them.
+            retries: number of times to retry a write failing with a network or server error, posts are never retried.
+        Returns:
+            A WriteBehindQueue using this Api.
+        """
+        return WriteBehindQueue(self, delay, retries)
+
+    def _request(self, http_method, note): #Clean this up a little -htormey
+        """
+        Perform a http request on a note.
+
+        Args:
+            http_metod: what kind of http request is being made (i.e POST/DELETE/GET)
+        Returns:
+            The server's response page.
+        """
+        if http_method == self.HTTP_POST:
+            headers     = { 'Content-type' : "application/x-www-form-urlencoded" }
+            if isinstance(note, Note):
+                #Edit an existing note
+                params         = self._encode_form(note.dictionary, headers)
+                page           = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note.note_id) + '.json'
+            else:
+                params      = self._encode_form(dict(text=note), headers)
+                page        = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+            response, data = self._basic_auth_request(page, headers=headers, method=self.HTTP_POST, params=params)
+        elif http_method == self.HTTP_DELETE:
+            page            = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note)
+            response, data = self._basic_auth_request(page, method=self.HTTP_DELETE)
+
+        if response.status != 200:
+            raise SnapticError("Http error posting/editing/deleting note ", response.status, data)
+        self._clear_pages()
+        self._notify_write(http_method, note, data)
+        return data
+
+    def add_listener(self, listener):
+        """
+        Keep a local structure, i.e a NoteIndex, up to date with notes written
+        through this Api. After a note is posted or edited listener.note_saved(note)
+        is called with the Note as the server returned it, and after a note is
+        deleted listener.note_deleted(note_id) is called.
+
+        Args:
+            listener: object with note_saved and note_deleted methods. It may be called from several
+                      threads, and errors it raises are issued as RuntimeWarnings.
+        """
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        """
+        Stop telling listener about writes.
+        """
+        self._listeners = [l for l in self._listeners if l is not listener]
+
+    def _notify_write(self, http_method, note, data):
+        """
+        Apply a successful write of note to the cached notes and json, and
+        tell listeners about it. data is the server's response page.
+        """
+        listeners = self._listeners
+        if http_method == self.HTTP_DELETE:
+            note_id = getattr(note, 'note_id', note)
+            if isinstance(note_id, basestring) and note_id.isdigit():
+                note_id = int(note_id)
+            self._write_through([], [note_id])
+            for listener in listeners:
+                self._call_listener(listener.note_deleted, note_id)
+            return
+        records, saved = [], []
+        if self._notes is not None or self._json is not None or listeners:
+            try:
+                records = [r for r in self._loads(data, 'notes')['notes'] if 'id' in r]
+                saved   = [self._make_note(dict(r, tags=list(r.get('tags', [])))) for r in records]
+            except Exception:
+                #The write itself succeeded, the caches are refetched rather than failing it
+                records, saved = [], []
+        if not saved and isinstance(note, Note):
+            saved = [note]
+        self._write_through(records, [], saved)
+        for saved_note in saved:
+            for listener in listeners:
+                self._call_listener(listener.note_saved, saved_note)
+
+    def _call_listener(self, method, *args):
+        """
+        Call a listener method, turning any error it raises into a warning so
+        it can't fail a write which already succeeded on the server.
+        """
+        try:
+            method(*args)
+        except Exception as e:
+            warnings.warn("snaptic listener %r failed: %s" % (method, e), RuntimeWarning)
+
+    def _write_through(self, records, deleted, notes=None):
+        """
+        Update the cached notes and json with records returned by a write and
+        ids of deleted notes. A cache which can't be updated is marked stale.
+        """
+        self._cache_lock.acquire()
+        try:
+            if self._notes is not None:
+                cached = self._notes
+                if not isinstance(cached, _IdIndex) or (notes is not None and not notes):
+                    self._mark_stale('notes')
+                else:
+                    for note_id in deleted:
+                        cached.remove(note_id)
+                    for saved in notes or ():
+                        cached.save(saved)
+                    self._cache_state['notes']['writes'] += 1
+            if self._json is not None:
+                try:
+                    index = self._json_index()
+                except (ValueError, TypeError, AttributeError):
+                    index = None
+                if index is None or (notes is not None and not records):
+                    self._mark_stale('json')
+                else:
+                    for note_id in deleted:
+                        index.remove(note_id)
+                    for record in records:
+                        index.save(record)
+                    self._cache_state['json']['writes'] += 1
+        finally:
+            self._cache_lock.release()
+
+    def _store_notes(self, notes):
+        self._cache_lock.acquire()
+        try:
+            if not isinstance(notes, LazyNotes):
+                notes = _IdIndex(notes, lambda note: note.note_id)
+            self._notes = notes
+            self._cache_state['notes'] = dict(fetched_at=time.time(), writes=0, stale=False)
+        finally:
+            self._cache_lock.release()
+
+    def _store_json(self, data):
+        self._cache_lock.acquire()
+        try:
+            self._json          = data
+            self._json_records  = None
+            self._cache_state['json'] = dict(fetched_at=time.time(), writes=0, stale=False)
+        finally:
+            self._cache_lock.release()
+
+    def _json_index(self):
+        #Caller must hold self._cache_lock. Decode the cached json once, on the first write applied to it.
+        if self._json_records is None:
+            document = json.loads(self._json)
+            self._json_records = (document, _IdIndex(document.get('notes', []), lambda record: record.get('id')))
+        return self._json_records[1]
+
+    def _cached_json(self):
+        """
+        The cached json text, re-encoded if writes have been applied to it since it was fetched.
+        """
+        self._cache_lock.acquire()
+        try:
+            if self._json_records is not None:
+                document, index = self._json_records
+                notes = index.list()
+                if notes is not document.get('notes'):
+                    document['notes']   = notes
+                    self._json          = json.dumps(document)
+            return self._json
+        finally:
+            self._cache_lock.release()
+
+    def _mark_stale(self, name):
+        state = self._cache_state[name]
+        if state is not None:
+            state['stale'] = True
+
+    def _cache_fresh(self, name):
+        state = self._cache_state[name]
+        if state is None or state['stale']:
+            return False
+        return self._max_age is None or time.time() - state['fetched_at'] <= self._max_age
+
+    def cache_status(self):
+        """
+        Report how current the cached notes and json are.
+
+        Returns:
+            A dictionary with 'notes' and 'json' keys, each None if nothing is cached, or a
+            dictionary of age (seconds since the last full fetch), writes (number of writes
+            applied to the cached copy since) and stale (True if a write could not be
+            applied, the next read then fetches it again).
+        """
+        self._cache_lock.acquire()
+        try:
+            status = {}
+            for name, state in self._cache_state.items():
+                if state is None:
+                    status[name] = None
+                else:
+                    status[name] = dict(age=time.time() - state['fetched_at'], writes=state['writes'],
+                                        stale=state['stale'] or not self._cache_fresh(name))
+            return status
+        finally:
+            self._cache_lock.release()
+
+    def _encode_form(self, fields, headers):
+        """
+        Url encode form fields for a POST body, gzip compressing it and
+        setting the Content-Encoding header if it is over compress_over bytes.
+        """
+        params = urlencode(fields)
+        if self._compress_over is not None and len(params) >= self._compress_over:
+            params                      = _gzip(params)
+            headers['Content-Encoding'] = 'gzip'
+        return params
+
+    def get_image_with_id(self, id, revision_id=None, md5=None):
+        """
+        Get image data associated with a given id.
+
+        Args:
+            id: id of image to be fetched.
+            revision_id: revision of the image, lets the image cache answer without downloading.
+            md5: md5 of the image, lets the image cache answer without downloading.
+        Returns:
+            Data associated with image id.
+        """
+        url = self.API_ENDPOINT_IMAGES_VIEW  + str(id)
+        return self._image_data(url, ImageCache.key(md5, id, revision_id))
+
+    def _image_data(self, url, key, timeout=None):
+        """
+        Image data for url from the image cache if key is in it, otherwise
+        downloaded, once however many threads ask for it, and stored under key.
+        """
+        cache = self._image_cache
+        if cache is None or key is None:
+            return self._fetch_url(url, timeout=timeout)
+        data = cache.get(key)
+        if data is not None:
+            return data
+        def fetch():
+            data = self._fetch_url(url, timeout=timeout)
+            cache.set(key, data)
+            return data
+        return self._coalesced(('image', key), fetch)
+
+    def get_user_id(self):
+        """
+        Get ID of API user.
+
+        Returns: 
+            Id of snaptic user associated with API instance.
+        """
+        user = self._user
+        if user:
+            return user.id
+        else:
+            raise SnapticError("Error user id not set, try calling GetNotes.")
+
+    @Property
+    def notes():
+        doc = "A parsed list of note objects"
+        def fget(self):
+            self._cache_lock.acquire()
+            try:
+                notes = self._notes
+                if notes and self._cache_fresh('notes'):
+                    return isinstance(notes, _IdIndex) and notes.list() or notes
+            finally:
+                self._cache_lock.release()
+            return self.get_notes()
+        return locals()
+
+    def get_notes(self, lazy=False):
+        """
+        Get notes and update the Api's internal cache. Threads calling this
+        while another thread's request is in flight share its result.
+
+        Args:
+            lazy: return a LazyNotes which only builds Note objects when they are accessed.
+        Returns:
+            A list of Note objects from the snaptic users account.
+        """
+        url          = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+        notes        = self._coalesced(('notes', lazy), lambda: self._fetch_notes(url, lazy))
+        self._store_notes(notes)
+        if self._tag_index is not None:
+            self._tag_index.rebuild(notes)
+        return notes
+
+    def _fetch_notes(self, url, lazy=False):
+        records = self._fetch_records(url, 'notes')['notes']
+        if lazy:
+            return LazyNotes(self, records)
+        return self._make_notes({'notes': records})
+
+    def _fetch_records(self, url, document):
+        """
+        Fetch and decode a page of notes. When the response comes from the
+        cache the decoded page is reused, and every call gets its own copy of
+        the note records, so notes built from them can be changed freely.
+        """
+        page = self._fetch_parsed(url, lambda source: self._loads(source, document), document)
+        if self._cache is None:
+            return page
+        records = []
+        for record in page.get('notes', []):
+            if 'tags' in record:
+                record = dict(record, tags=list(record['tags']))
+            else:
+                record = dict(record)
+            records.append(record)
+        return dict(page, notes=records)
+
+    def stream_notes(self, cursor_position=None, chunk_size=65536):
+        """
+        Stream notes from the server, parsing the notes array incrementally as
+        it is read from the socket so only one note is held in memory at a
+        time. Unlike get_notes this does not update the Api's internal cache.
+
+        Args:
+            cursor_position: cursor position to stream, None (or 0) streams every note in the account.
+            chunk_size: number of bytes to read from the socket at a time.
+        Returns:
+            A generator of note objects.
+        """
+        url = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+        if cursor_position:
+            url += self.API_ENDPOINT_CURSOR + str(cursor_position)
+        limiter     = self._rate_limiter
+        if limiter is not None:
+            limiter.acquire(getattr(self._local, 'deadline', None))
+        start       = time.time()
+        try:
+            pool, conn, response = self._open_request(url)
+        except:
+            if limiter is not None:
+                limiter.release(self._endpoint(url), 'error', time.time() - start)
+            raise
+        body        = _ContentDecoder(response, chunk_size)
+        read        = body.read
+        finished    = False
+        try:
+            if response.status != 200:
+                data     = read(None)
+                finished = True
+                raise SnapticError("Http error", response.status, data)
+            for item in _iter_json_array(read, 'notes', chunk_size):
+                note = _json_loads(item)
+                if 'id' in note:
+                    yield self._make_note(note)
+            finished = True
+        finally:
+            self.metrics.record_request(self._endpoint(url), response.status, time.time() - start, 0, body.received)
+            if limiter is not None:
+                limiter.release(self._endpoint(url), response.status, time.time() - start, _retry_after(response))
+            if finished:
+                pool.put(conn, response)
+            else:
+                pool.discard(conn)
+
+    def get_notes_from_cursor(self, cursor_position, lazy=False):
+        """
+        Get a batch of upto 20 notes from a given cursor position. See
+        description given for json_cursor for further details on how 
+        cursors work with snaptic.
+
+        Args:
+            cursor_position: cursor position to grab 20 notes from (i.e -1 is most recent 20)
+            lazy: return a LazyNotes which only builds Note objects when they are accessed.
+        Returns:
+            A list of note objects based on the contents of the users account.
+        """
+        return self.get_page(cursor_position, lazy).notes
+
+    def get_cursor_information(self, cursor_position):
+        """
+        Gets information about cursor at a given position. See json_cursor for further 
+        details on how cursors work with snaptic.
+
+        Args:
+            cursor_position: cursor position you want to find out about.
+        Returns:
+            A dictionary containing previous_cursor, next_cursor and note count.
+        """
+        #A lazy page reads the cursor fields without building any of its notes
+        return self.get_page(cursor_position, lazy=True).cursor_information
+
+    def get_page(self, cursor_position, lazy=False, refresh=False):
+        """
+        Get the notes and cursor information of a cursor position with one
+        request. If the Api was given a PageCache recently fetched pages are
+        kept in it, so going back and forth between pages, or asking for the
+        notes and then the cursor information of the same page, only
+        downloads it once.
+
+           Example usage:
+
+               >>> page = api.get_page(-1)
+               >>> while page.next_cursor:
+               ...     page = api.get_page(page.next_cursor)
+
+        Args:
+            cursor_position: cursor position to grab 20 notes from (i.e -1 is most recent 20)
+            lazy: hold the notes in a LazyNotes which only builds Note objects when they are accessed.
+            refresh: fetch the page from the server even if it is cached.
+        Returns:
+            A Page object.
+        """
+        url     = self._cursor_url(cursor_position)
+        key     = (self._cache_key(url), lazy)
+        if not refresh and self._pages is not None:
+            page = self._pages.get(key)
+            if page is not None:
+                return page
+        page    = self._make_page(cursor_position, self._fetch_records(url, 'cursor'), lazy)
+        if self._pages is not None:
+            self._pages.set(key, page)
+        return page
+
+    def _clear_pages(self):
+        if self._pages is not None:
+            self._pages.clear()
+
+    def _parse_page(self, cursor_position, source, lazy=False):
+        """
+        Parse a cursor page returned from snaptic into a Page object.
+        """
+        return self._make_page(cursor_position, self._loads(source, 'cursor'), lazy)
+
+    def _make_page(self, cursor_position, page, lazy=False):
+        """
+        Instantiate a Page object from an already decoded cursor page.
+        """
+        if lazy:
+            notes = LazyNotes(self, page.get('notes', []))
+        else:
+            notes = self._make_notes(page)
+        return Page(cursor_position, notes, page.get('previous_cursor'), page.get('next_cursor'), page.get('count'))
+
+    def iter_notes(self, start_cursor=-1, prefetch=2):
+        """
+        Iterate over notes page by page, starting at a cursor position and
+        following next_cursor until the last page. While the caller works on
+        one page, a background thread fetches and parses up to prefetch pages
+        ahead of it. Each page is downloaded once.
+
+        Args:
+            start_cursor: cursor position to start from (i.e -1 is most recent 20).
+            prefetch: number of pages to read ahead, 0 fetches pages only when needed.
+        Returns:
+            A generator of note objects.
+        """
+        if prefetch <= 0:
+            cursor = start_cursor
+            while cursor:
+                notes, cursor = self._fetch_page(cursor)
+                for note in notes:
+                    yield note
+            return
+
+        pages   = Queue.Queue(prefetch)
+        stop    = threading.Event()
+
+        def put(item):
+            while not stop.isSet():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def read_ahead():
+            cursor = start_cursor
+            try:
+                while cursor and not stop.isSet():
+                    notes, cursor = self._fetch_page(cursor)
+                    if not put((notes, None)):
+                        return
+            except Exception as e:
+                put((None, e))
+                return
+            put((None, None))
+
+        worker = threading.Thread(target=self._in_thread(read_ahead))
+        worker.setDaemon(True)
+        worker.start()
+        try:
+            while True:
+                notes, error = pages.get()
+                if error is not None:
+                    raise error
+                if notes is None:
+                    return
+                for note in notes:
+                    yield note
+        finally:
+            stop.set()
+
+    def _fetch_page(self, cursor_position):
+        """
+        Fetch and parse one cursor page, never from the page cache.
+
+        Returns:
+            A tuple of (notes, next_cursor), next_cursor is 0 or None after the last page.
+        """
+        page        = self.get_page(cursor_position, refresh=True)
+        next_cursor = page.next_cursor
+        if next_cursor == cursor_position:
+            next_cursor = None
+        return page.notes, next_cursor
+
+    def _parse_cursor_info(self, source):
+        """
+        Parse cursor information with notes returned from snaptic.
+
+        Args:
+            source: A json object consisting of notes and cursor information
+        Returns:
+            A dictionary containing previous_cursor, next_cursor and note count.
+        """
+        cursor_info   = self._loads(source, 'cursor')
+        if 'next_cursor' in cursor_info and 'previous_cursor' in cursor_info and 'count' in cursor_info:
+            return {"previous_cursor": cursor_info['previous_cursor'], "next_cursor": cursor_info['next_cursor'], "count": cursor_info['count'] }
+        else:
+            SnapticError("Error keys missing from source JSON passed to _parse_cursor_info")
+
+    def get_user(self):
+        """
+        Get user info. Threads calling this while another thread's request is
+        in flight share its result.
+
+        Returns:
+            A user object.
+        """
+        url          = "/" + self.API_VERSION + self.API_ENDPOINT_USER_JSON
+        def parse(user_info):
+            return self._parse_user_info(user_info)
+        user         = self._coalesced('user', lambda: self._fetch_parsed(url, parse, 'user'))
+        self._user   = user
+        return user
+
+    @Property
+    def json():
+        doc = "Json object of notes stored in account."
+        def fget(self):
+            data = self._cached_json()
+            if data and self._cache_fresh('json'):
+                return data #should I return json.load(sef._json) ? -htormey
+            else:
+                return self.get_json()
+        return locals()
+
+    def get_json(self):
+        """
+        Get json object and update the cache.
+
+        Returns:
+            A json object representing all notes in a users account.
+        """
+        url         = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+        data        = self._coalesced('json', lambda: self._fetch_url(url))
+        self._store_json(data)
+        return data
+
+    def get_tags(self):
+        """
+        Fetch json object containing tags from users account.
+
+        Returns:
+            A json object containing tags and related information (number of notes per tag, etc).
+        """
+        url         = "/" + self.API_VERSION + self.API_ENDPOINT_TAGS_JSON
+        tags        = self._coalesced('tags', lambda: self._fetch_url(url))
+        return tags
+
+    def get_tag_list(self):
+        """
+        Fetch the tags of the users account from the server.
+
+        Returns:
+            A list of Tag objects.
+        """
+        url         = "/" + self.API_VERSION + self.API_ENDPOINT_TAGS_JSON
+        return self._coalesced('tag_list', lambda: self._fetch_parsed(url, self._parse_tags, 'tags'))
+
+    def _parse_tags(self, source):
+        """
+        Parse JSON tags returned from snaptic into a list of Tag objects.
+        """
+        return [Tag(tag['name'], int(tag.get('count') or 0)) for tag in self._loads(source, 'tags').get('tags', [])]
+
+    @Property
+    def tag_index():
+        doc = "A TagIndex of the notes in the account, built from Api.notes and kept current with writes."
+        def fget(self):
+            index = self._tag_index
+            if index is None:
+                index = TagIndex(self.notes)
+                self.add_listener(index)
+                self._tag_index = index
+            return index
+        return locals()
+
+    @Property
+    def tags():
+        doc = "A list of Tag objects counted locally from the account's notes, see tag_index."
+        def fget(self):
+            return self.tag_index.tags()
+        return locals()
+
+    def get_notes_with_tag(self, *tags):
+        """
+        Find notes carrying every one of the given tags, using the local tag index.
+
+        Args:
+            tags: tag names.
+        Returns:
+            A list of Note objects.
+        """
+        return self.tag_index.notes(*tags)
+
+    def _coalesced(self, key, func):
+        """
+        Call func, or share the result of a call for the same key which another thread already has in flight.
+        """
+        return self._flight.do(key, func)
+
+    def json_cursor(self, cursor_position):
+        """
+        Get batches of 20 notes in JSON format from a given cursor position i.e -1, 1,
+        etc. For example: -1 returns the most recent 20 notes, 1 returns the previous 20
+        before that, etc. One exeption to note is that 0 returns a JSON object for all
+        notes in a given account.
+
+        Args:
+            cursor_position: cursor position to grab 20 notes from (i.e -1 is most recent 20).
+        Returns:
+            A json object containing notes from cursor position requested.
+        """
+        cursor      = self._fetch_url(self._cursor_url(cursor_position))
+        return cursor
+
+    def _cursor_url(self, cursor_position):
+        return "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON + self.API_ENDPOINT_CURSOR + str(cursor_position)
+
+    def _fetch_url(self, url, timeout=None):
+        """
+        Perform a basic auth request on a given snaptic API endpoint.
+
+        Args:
+            url: Snaptic Api endpoint (i.e /v1/notes.json etc).
+            timeout: socket timeout for this request, defaults to the Api's timeout.
+        Returns:
+            The server's response page.
+        """
+        return self._cached_fetch(url, timeout)[0]
+
+    def _cached_fetch(self, url, timeout=None):
+        """
+        Fetch a snaptic API endpoint, as a conditional request if the Api has a
+        cache holding validators for it.
+
+        Args:
+            url: Snaptic Api endpoint (i.e /v1/notes.json etc).
+            timeout: socket timeout for this request, defaults to the Api's timeout.
+        Returns:
+            A tuple of (data, entry) where entry is the cache entry holding data, or None if it isn't cached.
+        """
+        if self._cache is None:
+            response, data = self._get(url, timeout=timeout)
+            if response.status != 200:
+                raise SnapticError("Http error", response.status, data)
+            return data, None
+
+        key     = self._cache_key(url)
+        entry   = self._cache.get(key)
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match']        = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since']    = entry['last_modified']
+        response, data = self._get(url, headers, timeout)
+        if response.status == 304 and entry is not None:
+            return entry['body'], entry
+        if response.status != 200:
+            raise SnapticError("Http error", response.status, data)
+        etag            = response.getheader('etag')
+        last_modified   = response.getheader('last-modified')
+        if etag or last_modified:
+            entry = dict(etag=etag, last_modified=last_modified, body=data, parsed={})
+            self._cache.set(key, entry)
+            return data, entry
+        return data, None
+
+    @contextlib.contextmanager
+    def budget(self, seconds):
+        """
+        Limit the total time spent on all requests made by this thread inside
+        a with block, including follow-up requests such as the user lookup and
+        image downloads of get_notes. Socket timeouts are cut down to the time
+        left and a SnapticError is raised once it runs out. Nested budgets
+        never extend an outer one.
+
+           Example usage:
+
+               >>> with api.budget(5.0):
+               ...     notes = api.get_notes()
+
+        Args:
+            seconds: number of seconds the block may spend on requests.
+        """
+        previous = getattr(self._local, 'deadline', None)
+        deadline = time.time() + seconds
+        if previous is not None:
+            deadline = min(deadline, previous)
+        self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def _request_timeout(self, timeout=None):
+        """
+        Socket timeout for the next request: timeout, or the Api's timeout,
+        capped by what is left of the current budget.
+        """
+        timeout     = timeout or self._timeout
+        deadline    = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return timeout
+        remaining   = deadline - time.time()
+        if remaining <= 0:
+            raise SnapticError("Deadline exceeded", None, None)
+        return min(timeout, remaining)
+
+    def _in_thread(self, func):
+        """
+        Wrap func to run in another thread under the calling thread's budget.
+        """
+        deadline = getattr(self._local, 'deadline', None)
+        def run(*args):
+            self._local.deadline = deadline
+            return func(*args)
+        return run
+
+    def _get(self, url, headers={}, timeout=None):
+        """
+        Make an idempotent GET request, retrying network and server errors and
+        429 responses with jittered exponential backoff while the budget
+        allows. A Retry-After header lengthens the wait.
+
+        Returns:
+            A tuple of (response, data), the last response if every retry got a server error.
+        """
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response, data = self._hedged_get(url, headers, timeout)
+                if response.status < 500 and response.status != 429:
+                    return response, data
+            except (socket.error, httplib.HTTPException) as e:
+                error = e
+            if attempt >= self._retries:
+                if error is not None:
+                    raise error
+                return response, data
+            delay       = random.uniform(0, self._backoff * 2 ** attempt)
+            if error is None:
+                delay   = max(delay, _retry_after(response) or 0)
+            deadline    = getattr(self._local, 'deadline', None)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise SnapticError("Deadline exceeded fetching %s" % url, None, None)
+            time.sleep(delay)
+            attempt += 1
+
+    def _hedged_get(self, url, headers={}, timeout=None):
+        """
+        Make a GET request. If hedging is enabled and no response has arrived
+        after hedge_after seconds, send the same request on a second
+        connection and return whichever response comes back first.
+        """
+        if not self._hedge_after:
+            return self._basic_auth_request(url, headers=headers, timeout=timeout)
+
+        results = Queue.Queue()
+        def attempt():
+            try:
+                results.put((True, self._basic_auth_request(url, headers=headers, timeout=timeout)))
+            except Exception as e:
+                results.put((False, e))
+        def start():
+            thread = threading.Thread(target=self._in_thread(attempt))
+            thread.setDaemon(True)
+            thread.start()
+
+        start()
+        try:
+            ok, value = results.get(timeout=self._hedge_after)
+        except Queue.Empty:
+            start()
+            ok, value = results.get()
+            if not ok:
+                ok, value = results.get()
+        if not ok:
+            raise value
+        return value
+
+    def _fetch_parsed(self, url, parse, name):
+        """
+        Fetch and parse a snaptic API endpoint. When the response comes from the
+        cache, the result of an earlier parse of the same body is reused.
+
+        Args:
+            url: Snaptic Api endpoint (i.e /v1/notes.json etc).
+            parse: function turning the response page into a result.
+            name: name the parsed result is cached under.
+        Returns:
+            The parsed result.
+        """
+        data, entry = self._cached_fetch(url)
+        if entry is None:
+            return parse(data)
+        if name not in entry['parsed']:
+            entry['parsed'][name] = parse(data)
+        return entry['parsed'][name]
+
+    def _cache_key(self, url):
+        """
+        Key responses by server, endpoint and account, without keeping credentials in the key.
+        """
+        auth = hashlib.sha1(repr(sorted(self._get_auth_headers().items()))).hexdigest()
+        return "%s:%s%s#%s" % (self._url, self._port, url, auth)
+
+    def _get_auth_headers(self):
+        """
+        Switch between basic auth and cookie auth depending on which properties
+        self has.
+        """
+        if hasattr(self, "_username") and hasattr(self, "_password"):
+            return self._make_basic_auth_headers(self._username, self._password)
+        elif hasattr(self, "_cookie_epass"):
+            return self._make_cookie_auth_headers(self._cookie_epass)
+        else:
+            raise SnapticError("No username/password combination\
+                                or cookie authentication provided")
+
+    def _make_basic_auth_headers(self, username, password):
+        """
+        Encode headers for basic auth request.
+
+        Args::
+
+            username: snaptic username to be used.
+            password: password to be used.
+
+        Returns:
+            Dictionary with encoded basic auth values.
+        """
+        if username and password:
+            headers = dict(Authorization="Basic %s"
+                    %(base64.b64encode("%s:%s" %(username, password))))
+        else:
+            raise SnapticError("Error making basic auth headers with username: %s, password: %s" % (username, password))
+        return headers
+
+    def _make_cookie_auth_headers(self, cookie_epass):
+        """
+        Encode headers for cookie auth request.
+
+        Args::
+
+            cookie_epass: cookie auth token to be used.
+
+        Returns:
+            Dictionary with encoded basic auth values.
+        """
+        if cookie_epass:
+            return {
+                "Cookie": "cookie_epass={0}".format(cookie_epass)
+            }
+        else:
+            raise SnapticError("Error making cookie auth headers with\
+                               cookie:{0}".format(cookie_epass))
+
+    def _basic_auth_request(self, path, method=HTTP_GET, headers={}, params=None,
+                            host=None, port=None, use_ssl=None, timeout=None):
+        """
+        Make a HTTP request with basic auth header and supplied method over a
+        pooled keep-alive connection. Defaults to operating over SSL.
+
+        Args::
+
+            path: Snaptic API endpoint
+            metthod: which http method to use (PUT/DELETE/GET)
+            headers: Additional header to use with request.
+            params: Request body, if any.
+            host: server to send request to, defaults to the Api's url.
+            port: port to send request on, defaults to the Api's port.
+            use_ssl: use https or not, defaults to the Api's setting.
+            timeout: socket timeout for this request, defaults to the Api's timeout.
+
+        Returns:
+            A tuple of (response, data) where data is the server's response page, decoded if
+            the server compressed it.
+        """
+        limiter     = self._rate_limiter
+        if limiter is not None:
+            limiter.acquire(getattr(self._local, 'deadline', None))
+        start       = time.time()
+        status      = 'error'
+        data        = ''
+        received    = 0
+        response    = None
+        try:
+            try:
+                pool, conn, response = self._open_request(path, method, headers, params, host, port, use_ssl, timeout)
+                try:
+                    body        = _ContentDecoder(response)
+                    data        = body.read()
+                    received    = body.received
+                except:
+                    pool.discard(conn)
+                    raise
+            except socket.timeout:
+                deadline = getattr(self._local, 'deadline', None)
+                if deadline is not None and time.time() >= deadline - 0.01:
+                    raise SnapticError("Deadline exceeded requesting %s" % path, None, None)
+                raise
+            status = response.status
+        finally:
+            endpoint = self._endpoint(path, method)
+            self.metrics.record_request(endpoint, status, time.time() - start,
+                                        params is not None and len(params) or 0, received)
+            if limiter is not None:
+                limiter.release(endpoint, status, time.time() - start, response is not None and _retry_after(response) or None)
+        pool.put(conn, response)
+        return response, data
+
+    def _endpoint(self, path, method=HTTP_GET):
+        """
+        Name the API endpoint a request goes to, for metrics.
+        """
+        if method == self.HTTP_DELETE:
+            return 'delete'
+        if self.API_ENDPOINT_CURSOR in path:
+            return 'cursor'
+        if self.API_ENDPOINT_NOTES_JSON in path or self.API_ENDPOINT_NOTES in path:
+            return 'notes'
+        if self.API_ENDPOINT_USER_JSON in path:
+            return 'user'
+        if self.API_ENDPOINT_TAGS_JSON in path:
+            return 'tags'
+        if self.API_ENDPOINT_IMAGES in path or self.API_ENDPOINT_IMAGES_VIEW in path:
+            return 'images'
+        return 'other'
+
+    def _loads(self, source, document):
+        """
+        Decode JSON, recording the time taken under the document type.
+        """
+        start = time.time()
+        value = _json_loads(source)
+        self.metrics.record_parse(document, time.time() - start)
+        return value
+
+    def _open_request(self, path, method=HTTP_GET, headers={}, params=None,
+                      host=None, port=None, use_ssl=None, timeout=None):
+        """
+        Send a request with auth headers on a pooled connection, leaving the
+        response body unread. A reused connection which the server has dropped
+        in the meantime is replaced with a fresh one and the request is sent
+        again, unless it is a POST which the server may already have received.
+
+        Args:
+            See _basic_auth_request.
+
+        Returns:
+            A tuple of (pool, connection, response). The caller must read the
+            response and then hand the connection back with pool.put() or pool.discard().
+        """
+        h = self._get_auth_headers()
+        if self._compression:
+            h['Accept-Encoding'] = 'gzip, deflate'
+        h.update(headers)
+        pool = self._get_pool(host or self._url, port or self._port,
+                              self._use_ssl if use_ssl is None else use_ssl)
+        timeout = self._request_timeout(timeout)
+        idempotent = method in (self.HTTP_GET, self.HTTP_DELETE)
+        while True:
+            conn, reused = pool.get(timeout)
+            sent = False
+            try:
+                conn.request(method, path, params, headers=h)
+                sent = True
+                response = conn.getresponse()
+                self.metrics.record_connection(self._endpoint(path, method), reused)
+                return pool, conn, response
+            except socket.timeout:
+                pool.discard(conn)
+                raise
+            except (socket.error, httplib.BadStatusLine):
+                pool.discard(conn)
+                if reused and (idempotent or not sent):
+                    if hasattr(params, 'seek'):
+                        params.seek(0)
+                    continue
+                raise
+            except:
+                pool.discard(conn)
+                raise
+
+    def _get_pool(self, host, port, use_ssl):
+        """
+        Get the connection pool for a (host, port, ssl) destination, creating it if needed.
+        """
+        key = (host, port, use_ssl)
+        self._pools_lock.acquire()
+        try:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(host, port, use_ssl, timeout=self._timeout,
+                                                         maxsize=self._pool_size)
+            return pool
+        finally:
+            self._pools_lock.release()
+
+    def get_pool_stats(self):
+        """
+        Get connection statistics for every destination this Api has talked to.
+
+        Returns:
+            A dictionary mapping (host, port, use_ssl) to a dictionary of counters
+            (created, reused, discarded, requests, idle, in_use, open).
+        """
+        self._pools_lock.acquire()
+        try:
+            pools = self._pools.items()
+        finally:
+            self._pools_lock.release()
+        return dict((key, pool.stats) for key, pool in pools)
+
+    def close(self):
+        """
+        Close all idle keep-alive connections held by this Api.
+        """
+        self._pools_lock.acquire()
+        try:
+            pools = self._pools.values()
+        finally:
+            self._pools_lock.release()
+        for pool in pools:
+            pool.close()
+
+    def _parse_user_info(self, source):
+        """
+        Parse JSON user returned from snaptic, instantiate a User object from it.
+
+        Args:
+            source: Json object representing a user
+        Returns:
+            A User object.
+        """
+        user_info   = self._loads(source, 'user')
+
+        if 'user' in user_info:
+            user       = User(user_info['user']['id'], user_info['user']['user_name'], user_info['user']['created_at'], user_info['user']['email'])
+            self._user = user
+            return user
+        else:
+            SnapticError("Error no user key found in source JSON passed to _parse_user_info")
+
+    def _parse_notes( self, source, get_image_data=False):
+        """
+        parse JSON notes returned from snaptic, instantiate a list of note objects from it.
+
+        Args::
+
+            source: A json object representing a list of notes.
+            get_images: if images are associated with notes, download them now.
+        Returns:
+            A list of note objects.
+        """
+        return self._make_notes(self._loads(source, 'notes'), get_image_data)
+
+    def _make_notes(self, json_notes, get_image_data=False):
+        """
+        Instantiate a list of note objects from already decoded JSON notes.
+
+        Args::
+
+            json_notes: A dictionary with a 'notes' key, as decoded from snaptic's JSON.
+            get_images: if images are associated with notes, download them now.
+        Returns:
+            A list of note objects.
+        """
+        notes       = []
+
+        for note in json_notes['notes']:
+            if 'id' in note:
+                notes.append(self._make_note(note))
+        if get_image_data:
+            self._fetch_image_data([image for note in notes for image in note.media])
+        return notes
+
+    def _fetch_image_data(self, images):
+        """
+        Download data for a list of images on a bounded pool of worker threads,
+        filling in each image's data attribute as its download finishes.
+
+        Args:
+            images: list of Image objects to fetch data for.
+        """
+        if not images:
+            return
+        todo    = Queue.Queue()
+        errors  = []
+        queued  = set()
+        for image in images:
+            #Notes referencing the same image revision share one Image, fetch it once
+            if id(image) not in queued:
+                queued.add(id(image))
+                todo.put(image)
+
+        def worker():
+            while not errors:
+                try:
+                    image = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    image.data = self._image_data(image.src, ImageCache.key(image.md5, image.id, image.revision_id),
+                                                  self._image_timeout)
+                except socket.timeout:
+                    errors.append(SnapticError("Timed out fetching image %s" % image.id))
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=self._in_thread(worker)) for i in range(min(self._image_workers, len(images)))]
+        for thread in workers:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _make_note(self, note):
+        """
+        Instantiate a note object from a single decoded JSON note.
+
+        Args:
+            note: A dictionary representing one note.
+        Returns:
+            A note object.
+        """
+        media           = []
+        location        = []
+        tags            = []
+        user            = None
+        shared          = self._shared_strings.setdefault
+
+        if 'user' in note:
+            owner = note['user']
+            if isinstance(owner, dict) and 'id' in owner:
+                #Share one id object between all notes of a user, as for strings
+                user = shared(owner['id'], owner['id'])
+            else:
+                user = (self._user or self.get_user()).id
+        if 'location' in note:
+            pass 
+        if 'tags' in note:
+            #Reuse the decoded list rather than copying it, tag names repeat across notes
+            tags = note['tags']
+            for i, tag in enumerate(tags):
+                tags[i] = shared(tag, tag)
+        if 'media' in note:
+            for item in note['media']:
+                if item['type'] == 'image':
+                    media.append(self._shared_image(item))
+
+        return Note(note['created_at'], note['modified_at'], note['reminder_at'], note['id'], note['text'], note['summary'],
+                    shared(note['source'], note['source']), shared(note['source_url'], note['source_url']),
+                    user, note['children'], media, tags, location)
+
+    def _shared_image(self, item):
+        """
+        Get the Image for a decoded media item, reusing the instance already
+        handed out for the same id and revision_id while it is still alive.
+        """
+        key     = (item['id'], item['revision_id'])
+        self._images_lock.acquire()
+        try:
+            image   = self._images.get(key)
+            if image is None:
+                image = Image(item['type'], item.get('md5'), item['id'], item['revision_id'], item['width'], item['height'],
+                              item['src'])
+                self._images[key] = image
+            return image
+        finally:
+            self._images_lock.release()
+
+class WriteBehindQueue(object):
+    """
+    Queue note writes and send them from a background thread, so callers
+    don't block on the network. Writes are held for up to delay seconds and
+    then sent in the order they were queued, and repeated edits of the same
+    note collapse into one request with the note's latest state. Deleting a
+    note drops its pending edits.
+
+    flush() blocks until every write queued so far has been delivered or has
+    failed after its retries, and close() flushes and stops the worker.
+    Writes are only kept in memory, so call close() before exiting.
+
+       Example usage:
+
+           >>> writer = api.write_behind(delay=2.0)
+           >>> note.text = 'Harry says'
+           >>> writer.edit_note(note)
+           >>> note.text = 'Harry says coolio'
+           >>> writer.edit_note(note)
+           >>> writer.close()
+           []
+    """
 
+    def __init__(self, api, delay=1.0, retries=3):
+        """
         Args:
-            note: note object to be edited
+            api: Api used to send writes.
+            delay: number of seconds to hold writes before sending them.
+            retries: number of times to retry a write failing with a network or server error, posts are never retried.
+        """
+        self._api           = api
+        self._delay         = delay
+        self._retries       = retries
+        self._cond          = threading.Condition()
+        self._order         = []
+        self._pending       = {}
+        self._first_queued  = None
+        self._in_flight     = 0
+        self._flushing      = 0
+        self._closed        = False
+        self._failures      = []
+        self._posts         = 0
+        self._coalesced     = 0
+        self._worker        = threading.Thread(target=self._run)
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    @property
+    def pending(self):
+        """
         Returns:
-            The server's response page.
+            Number of writes waiting to be sent.
         """
-        return self._request(self.HTTP_POST, note)
+        return len(self._pending)
+
+    @property
+    def coalesced(self):
+        """
+        Returns:
+            Number of edits which were merged into an already pending edit.
+        """
+        return self._coalesced
 
     def post_note(self, note):
         """
-        Post a note.
+        Queue posting a note.
 
         Args:
             note: text of note to be posted.
+        """
+        self._cond.acquire()
+        try:
+            self._posts += 1
+            key = ('post', self._posts)
+        finally:
+            self._cond.release()
+        self._put(key, self._api.post_note, note, False)
+
+    def edit_note(self, note):
+        """
+        Queue editing a note, replacing any edit of the same note still pending.
+
+        Args:
+            note: note object to be edited, its state is read when the edit is sent.
+        """
+        self._put(('edit', note.note_id), self._api.edit_note, note, True)
+
+    def delete_note(self, id):
+        """
+        Queue deleting a note and drop any edits of it still pending.
+
+        Args:
+            id: id of note to be deleted.
+        """
+        self._cond.acquire()
+        try:
+            self._pending.pop(('edit', id), None)
+        finally:
+            self._cond.release()
+        self._put(('delete', id), self._api.delete_note, id, True)
+
+    def _put(self, key, send, arg, idempotent):
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise SnapticError("Write queue is closed")
+            if key in self._pending:
+                self._coalesced += 1
+            else:
+                self._order.append(key)
+            self._pending[key] = (send, arg, idempotent)
+            if self._first_queued is None:
+                self._first_queued = time.time()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _next_write(self):
+        """
+        Wait until a write is due and take it off the queue.
+
         Returns:
-            The server's response page.
+            A (send, arg, idempotent) tuple, or None when the queue is closed and empty.
         """
-        return self._request(self.HTTP_POST, note) #change this to note_text to be a little clearer -htormey
+        self._cond.acquire()
+        try:
+            while True:
+                if self._pending:
+                    waited = time.time() - self._first_queued
+                    if self._flushing or self._closed or waited >= self._delay:
+                        break
+                    self._cond.wait(self._delay - waited)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            while True:
+                key = self._order.pop(0)
+                if key in self._pending:
+                    break
+            write = self._pending.pop(key)
+            if not self._pending:
+                self._first_queued = None
+            self._in_flight += 1
+            return write
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            write = self._next_write()
+            if write is None:
+                return
+            try:
+                error = self._send(*write)
+            except Exception as e:
+                error = _snaptic_error(e)
+            self._cond.acquire()
+            try:
+                self._in_flight -= 1
+                if error is not None:
+                    self._failures.append((write[1], error))
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _send(self, send, arg, idempotent):
+        """
+        Send one write, retrying network and server errors with exponential
+        backoff. Posts are not retried, the server may have created the note
+        before the error, and _open_request already resends requests which
+        never went out.
+
+        Returns:
+            None on success, otherwise the last SnapticError.
+        """
+        retries = idempotent and self._retries or 0
+        for attempt in range(retries + 1):
+            try:
+                send(arg)
+                return None
+            except SnapticError as e:
+                error = e
+                if len(e.args) > 1 and e.status is not None and e.status < 500:
+                    return error
+            except (socket.error, httplib.HTTPException) as e:
+                error = _snaptic_error(e)
+            except Exception as e:
+                #Not a network or server error, the write may have been applied so it isn't retried
+                return _snaptic_error(e)
+            if attempt < retries:
+                time.sleep(0.5 * 2 ** attempt)
+        return error
+
+    def flush(self, timeout=None):
+        """
+        Send every queued write now and wait until they have all been delivered or have failed.
+
+        Args:
+            timeout: number of seconds to wait at most, None to wait until done.
+        Returns:
+            A list of (note or id, SnapticError) tuples for writes which failed since the last flush.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self._cond.acquire()
+        try:
+            self._flushing += 1
+            self._cond.notifyAll()
+            try:
+                while self._pending or self._in_flight:
+                    if deadline:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise SnapticError("Timed out flushing %d writes" % (len(self._pending) + self._in_flight))
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._flushing -= 1
+            failures, self._failures = self._failures, []
+            return failures
+        finally:
+            self._cond.release()
+
+    def close(self, timeout=None):
+        """
+        Stop accepting writes, deliver the queued ones and stop the worker thread.
+
+        Args:
+            timeout: number of seconds to wait at most, None to wait until done.
+        Returns:
+            A list of (note or id, SnapticError) tuples for writes which failed since the last flush.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        failures = self.flush(timeout)
+        self._worker.join(timeout)
+        return failures
+
+class AccountPool(object):
+    """
+    Run operations for many snaptic accounts on one shared pool of worker
+    threads and keep-alive connections. Work is handed out round-robin
+    between accounts, at most per_account operations run for any one
+    account at a time and at most workers run in total, so one large
+    account cannot starve the others. Results are streamed back as
+    (key, result, error) tuples in the order they finish; error is the
+    exception an operation raised, or None.
+
+    Cursor walks are scheduled one page at a time and bulk writes one note
+    at a time, so they interleave fairly with other accounts' work.
+
+       Example usage:
+
+           >>> pool = snaptic.AccountPool(workers=16)
+           >>> for username, password in accounts:
+           ...     pool.add_account(username, username, password)
+           >>> for key, notes, error in pool.sync():
+           ...     print key, error or len(notes)
+           >>> pool.close()
+    """
+
+    def __init__(self, url=Api.API_SERVER, use_ssl=True, port=443, workers=8, per_account=1, **api_args):
+        """
+        Args:
+            url: The url of the api server which will handle the http(s) API requests.
+            use_ssl: Use ssl for basic auth or not.
+            port: The port to make http(s) requests on.
+            workers: number of operations run at once across all accounts.
+            per_account: number of operations run at once for any one account.
+            api_args: further keyword arguments for every account's Api, i.e timeout or retries.
+                      Accounts share one Metrics unless one is given here.
+        """
+        self._workers       = workers
+        self._per_account   = per_account
+        api_args.setdefault('pool_size', workers)
+        api_args.setdefault('metrics', Metrics())
+        self._api_args      = dict(api_args, url=url, use_ssl=use_ssl, port=port)
+        self.metrics        = api_args['metrics']
+        self._pools         = {}
+        self._pools_lock    = threading.Lock()
+        self._accounts      = {}
+        self._queues        = {}
+        self._running       = {}
+        self._ready         = collections.deque()
+        self._cond          = threading.Condition()
+        self._results       = Queue.Queue()
+        self._pending       = 0
+        self._threads       = []
+        self._closed        = False
+
+    def add_account(self, key, username=None, password=None, cookie_epass=None):
+        """
+        Add an account, authenticated with either username and password or a cookie.
+
+        Args:
+            key: name the account's results are reported under.
+            username: The username of the snaptic account.
+            password: The password of the snaptic account.
+            cookie_epass: snaptic authentication cookie.
+        Returns:
+            The account's Api, sharing the pool's connections.
+        """
+        api = Api(username, password, cookie_epass=cookie_epass, **self._api_args)
+        api._pools, api._pools_lock = self._pools, self._pools_lock
+        self._cond.acquire()
+        try:
+            self._accounts[key] = api
+        finally:
+            self._cond.release()
+        return api
+
+    def api(self, key):
+        """
+        Returns:
+            The Api of the account added under key.
+        """
+        return self._accounts[key]
+
+    @property
+    def keys(self):
+        """
+        Returns:
+            The keys of every account in the pool.
+        """
+        return self._accounts.keys()
+
+    def submit(self, key, func, *args):
+        """
+        Queue func(api, *args) to run for an account. Its outcome is streamed by results().
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise SnapticError("AccountPool is closed")
+            api = self._accounts[key]
+            queue = self._queues.get(key)
+            if not queue:
+                queue = self._queues[key] = collections.deque()
+                self._ready.append(key)
+            queue.append((api, func, args))
+            self._pending += 1
+            if len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def results(self):
+        """
+        Stream the outcome of every submitted operation as it finishes, until
+        none are left. Only one thread should consume results at a time.
+
+        Returns:
+            A generator of (key, result, error) tuples.
+        """
+        while True:
+            self._cond.acquire()
+            try:
+                if self._pending == 0:
+                    return
+            finally:
+                self._cond.release()
+            key, value, error = self._results.get()
+            self._cond.acquire()
+            try:
+                self._pending -= 1
+            finally:
+                self._cond.release()
+            yield key, value, error
+
+    def map(self, func, keys=None, *args):
+        """
+        Run func(api, *args) once for every account, or for the accounts in keys.
+
+        Returns:
+            A generator of (key, result, error) tuples, see results().
+        """
+        for key in (self.keys if keys is None else keys):
+            self.submit(key, func, *args)
+        return self.results()
+
+    def sync(self, keys=None, lazy=False):
+        """
+        Fetch every note of each account.
+
+        Returns:
+            A generator of (key, notes, error) tuples, see results().
+        """
+        return self.map(lambda api: api.get_notes(lazy), keys)
+
+    def walk(self, keys=None, start_cursor=-1, lazy=False):
+        """
+        Walk each account's cursor pages from start_cursor, one request per page.
+
+        Returns:
+            A generator of (key, Page, error) tuples, see results(), with each account's pages in order.
+        """
+        def fetch(api, cursor_position, key):
+            page = api.get_page(cursor_position, lazy)
+            if page.next_cursor and page.next_cursor != cursor_position:
+                self.submit(key, fetch, page.next_cursor, key)
+            return page
+        for key in (self.keys if keys is None else keys):
+            self.submit(key, fetch, start_cursor, key)
+        return self.results()
+
+    def post_notes(self, notes):
+        """
+        Args:
+            notes: dictionary of account key to a sequence of note texts to post.
+        Returns:
+            A generator of (key, response, error) tuples, one per note, see results().
+        """
+        return self._write(Api.post_note, notes)
+
+    def edit_notes(self, notes):
+        """
+        Args:
+            notes: dictionary of account key to a sequence of Note objects to save.
+        Returns:
+            A generator of (key, response, error) tuples, one per note, see results().
+        """
+        return self._write(Api.edit_note, notes)
+
+    def delete_notes(self, ids):
+        """
+        Args:
+            ids: dictionary of account key to a sequence of note ids to delete.
+        Returns:
+            A generator of (key, response, error) tuples, one per note, see results().
+        """
+        return self._write(Api.delete_note, ids)
+
+    def _write(self, method, items):
+        for key, values in items.items():
+            for value in values:
+                self.submit(key, method, value)
+        return self.results()
+
+    def close(self):
+        """
+        Stop the worker threads once queued operations have run and close all idle connections.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for thread in self._threads:
+            thread.join()
+        for pool in self._pools.values():
+            pool.close()
+
+    def _next(self):
+        """
+        Take the next operation, round-robin over accounts below their limit. Caller must hold self._cond.
+        """
+        for i in xrange(len(self._ready)):
+            key = self._ready[0]
+            self._ready.rotate(-1)
+            if self._running.get(key, 0) < self._per_account:
+                queue = self._queues[key]
+                task  = queue.popleft()
+                if not queue:
+                    self._ready.pop()
+                    del self._queues[key]
+                self._running[key] = self._running.get(key, 0) + 1
+                return key, task
+        return None
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                item = self._next()
+                while item is None:
+                    if self._closed and not self._ready:
+                        return
+                    self._cond.wait()
+                    item = self._next()
+            finally:
+                self._cond.release()
+            key, (api, func, args) = item
+            value, error = None, None
+            try:
+                value = func(api, *args)
+            except Exception as e:
+                error = e
+            self._cond.acquire()
+            try:
+                self._running[key] -= 1
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            self._results.put((key, value, error))
+
+class AsyncResult(object):
+    """
+    The eventual result of an AsyncApi call.
+
+    Results can be chained with then(), which runs a function on the value
+    once it arrives, or waited on with result(), which drives the event loop
+    until the value (or error) is available.
+    """
+
+    def __init__(self, api):
+        self._api       = api
+        self._done      = False
+        self._value     = None
+        self._error     = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        Returns:
+            True if the result or an error has been set.
+        """
+        return self._done
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_error(self, error):
+        self._finish(None, error)
+
+    def _finish(self, value, error):
+        if self._done:
+            return
+        self._done      = True
+        self._value     = value
+        self._error     = error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """
+        Call callback(result) once this result is done, or right away if it already is.
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def then(self, func):
+        """
+        Chain func onto this result.
+
+        Args:
+            func: called with the value of this result. It may return a plain value or another AsyncResult.
+        Returns:
+            An AsyncResult for the value returned by func. Errors are passed along unchanged.
+        """
+        chained = AsyncResult(self._api)
+        def callback(result):
+            if result._error is not None:
+                chained.set_error(result._error)
+                return
+            try:
+                value = func(result._value)
+            except Exception as e:
+                chained.set_error(e)
+                return
+            if isinstance(value, AsyncResult):
+                value.add_callback(lambda r: chained._finish(r._value, r._error))
+            else:
+                chained.set_result(value)
+        self.add_callback(callback)
+        return chained
+
+    def result(self, timeout=None):
+        """
+        Run the event loop until this result is done.
+
+        Args:
+            timeout: number of seconds to wait, None to wait until every request has completed or timed out.
+        Returns:
+            The value of the call. Raises the call's error if it failed.
+        """
+        self._api.run(timeout=timeout, until=self)
+        if not self._done:
+            raise SnapticError("Timed out waiting for result")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    @staticmethod
+    def gather(api, results):
+        """
+        Combine several results into one.
+
+        Returns:
+            An AsyncResult for a list of values in the same order as results. Fails with the first error.
+        """
+        combined    = AsyncResult(api)
+        values      = [None] * len(results)
+        pending     = [len(results)]
+        if not results:
+            combined.set_result(values)
+        def make_callback(index):
+            def callback(result):
+                if result._error is not None:
+                    combined.set_error(result._error)
+                    return
+                values[index] = result._value
+                pending[0] -= 1
+                if pending[0] == 0:
+                    combined.set_result(values)
+            return callback
+        for index, result in enumerate(results):
+            result.add_callback(make_callback(index))
+        return combined
+
+class _FakeSocket(object):
+    """
+    Feed a buffered HTTP response to httplib.HTTPResponse for parsing.
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO(self._data)
+
+class _AsyncHTTPRequest(asyncore.dispatcher):
+    """
+    A single HTTP/1.0 request over a non-blocking socket, driven by asyncore.
+    The response is buffered until the server closes the connection and then
+    parsed with httplib.
+    """
+
+    def __init__(self, host, port, use_ssl, method, path, headers, body, result, socket_map, timeout):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._host          = host
+        self._use_ssl       = use_ssl
+        self._result        = result
+        self._deadline      = time.time() + timeout
+        self._handshaking   = False
+        self._inbuf         = []
+        lines = ["%s %s HTTP/1.0" % (method, path), "Host: %s" % host]
+        for key, value in headers.items():
+            lines.append("%s: %s" % (key, value))
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        self._outbuf = "\r\n".join(lines) + "\r\n\r\n"
+        if hasattr(body, 'read'):
+            self._body = body
+        else:
+            self._outbuf += body or ""
+            self._body = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((host, port))
+        except socket.error as e:
+            self._fail(SnapticError("Error connecting to %s:%s: %s" % (host, port, e)))
+
+    def _fail(self, error):
+        self.close()
+        self._result.set_error(error)
+
+    def check_deadline(self, now):
+        if now > self._deadline:
+            self._fail(SnapticError("Timed out requesting from %s" % self._host))
+
+    def handle_connect(self):
+        if self._use_ssl:
+            if hasattr(ssl, 'create_default_context'):
+                context = ssl.create_default_context()
+                sock    = context.wrap_socket(self.socket, server_hostname=self._host,
+                                              do_handshake_on_connect=False)
+            else:
+                sock    = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+            self.del_channel()
+            self.set_socket(sock)
+            self._handshaking = True
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self._handshaking = False
+
+    def writable(self):
+        return not self.connected or self._handshaking or len(self._outbuf) > 0 or self._body is not None
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        if not self._outbuf and self._body is not None:
+            self._outbuf = self._body.read(65536)
+            if not self._outbuf:
+                self._body = None
+                return
+        try:
+            sent = self.socket.send(self._outbuf)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        try:
+            data = self.socket.recv(65536)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            if e.args[0] != ssl.SSL_ERROR_EOF and 'eof' not in str(e).lower():
+                raise
+            #Server closed without a TLS close_notify, httplib will spot a truncated body
+            data = None
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        if data:
+            self._inbuf.append(data)
+        else:
+            self.handle_close()
+
+    def handle_close(self):
+        self.close()
+        if self._result.done():
+            return
+        try:
+            response = httplib.HTTPResponse(_FakeSocket("".join(self._inbuf)))
+            response.begin()
+            data     = _ContentDecoder(response).read()
+        except (httplib.HTTPException, socket.error, SnapticError) as e:
+            self._result.set_error(SnapticError("Error reading response from %s: %s" % (self._host, e)))
+            return
+        self._result.set_result((response, data))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self._fail(SnapticError("Error requesting from %s: %s" % (self._host, error)))
+
+class AsyncApi(Api):
+    """
+    A non-blocking version of snaptic.Api. Every network call returns an
+    AsyncResult straight away; requests run concurrently on an asyncore
+    event loop which is driven by AsyncResult.result() or AsyncApi.run().
+    Several AsyncApi instances can share one loop by passing the same
+    socket_map.
+
+       Example usage:
+
+           >>> import snaptic
+           >>> api = snaptic.AsyncApi("username", "password")
+           >>> pages = [api.get_notes_from_cursor(n) for n in (-1, 1, 2)]
+           >>> api.run()
+           >>> [len(p.result()) for p in pages]
+           [20, 20, 20]
+    """
+
+    def __init__(self, username=None, password=None, url=Api.API_SERVER,
+                 use_ssl=True, port=443, timeout=10, cookie_epass=None, socket_map=None, **api_args):
+        """
+        Args:
+            username: The username of the snaptic account.
+            password: The password of the snaptic account.
+            url: The url of the api server which will handle the http(s) API requests.
+            use_ssl: Use ssl for basic auth or not.
+            port: The port to make http(s) requests on.
+            timeout: number of seconds to wait before giving up on a request.
+            socket_map: asyncore socket map to run requests on, shared between instances.
+            api_args: further keyword arguments of Api, i.e image_cache, page_cache or metrics.
+                      pool_size, retries, hedge_after and rate_limiter have no effect on the event loop.
+        """
+        Api.__init__(self, username, password, url, use_ssl, port, timeout, cookie_epass, **api_args)
+        if socket_map is None:
+            socket_map = {}
+        self._socket_map = socket_map
+        self._in_flight  = {}
+
+    def run(self, timeout=None, until=None):
+        """
+        Run the event loop until all requests on it have finished.
+
+        Args:
+            timeout: number of seconds to run for at most, None to run until done.
+            until: optional AsyncResult to stop at as soon as it is done.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while self._socket_map and not (until is not None and until.done()):
+            asyncore.loop(timeout=0.05, map=self._socket_map, count=1)
+            now = time.time()
+            for channel in self._socket_map.values():
+                channel.check_deadline(now)
+            if deadline and now > deadline:
+                break
+
+    def _basic_auth_request(self, path, method=Api.HTTP_GET, headers={}, params=None,
+                            host=None, port=None, use_ssl=None, timeout=None):
+        """
+        Start a HTTP request with auth headers on the event loop.
+
+        Returns:
+            An AsyncResult for a tuple of (response, data).
+        """
+        result  = AsyncResult(self)
+        h       = self._get_auth_headers()
+        if self._compression:
+            h['Accept-Encoding'] = 'gzip, deflate'
+        h.update(headers)
+        start   = time.time()
+        endpoint = self._endpoint(path, method)
+        def record(finished):
+            if finished._error is not None:
+                self.metrics.record_request(endpoint, 'error', time.time() - start, 0, 0)
+                return
+            response, data = finished._value
+            self.metrics.record_connection(endpoint, False)
+            self.metrics.record_request(endpoint, response.status, time.time() - start,
+                                        params is not None and len(params) or 0, len(data))
+        result.add_callback(record)
+        _AsyncHTTPRequest(host or self._url, port or self._port,
+                          self._use_ssl if use_ssl is None else use_ssl,
+                          method, path, h, params, result, self._socket_map, timeout or self._timeout)
+        return result
+
+    def _fetch_url(self, url, timeout=None):
+        def check(response_data):
+            response, data = response_data
+            if response.status != 200:
+                raise SnapticError("Http error", response.status, data)
+            return data
+        return self._basic_auth_request(url, timeout=timeout).then(check)
+
+    def _image_data(self, url, key, timeout=None):
+        cache = self._image_cache
+        if cache is None or key is None:
+            return self._fetch_url(url, timeout=timeout)
+        data = cache.get(key)
+        if data is not None:
+            return self._resolved(data)
+        def store(data):
+            cache.set(key, data)
+            return data
+        return self._coalesced(('image', key), lambda: self._fetch_url(url, timeout=timeout).then(store))
+
+    def _request(self, http_method, note):
+        if http_method == self.HTTP_POST:
+            headers     = { 'Content-type' : "application/x-www-form-urlencoded" }
+            if isinstance(note, Note):
+                params  = self._encode_form(note.dictionary, headers)
+                page    = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note.note_id) + '.json'
+            else:
+                params  = self._encode_form(dict(text=note), headers)
+                page    = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+            pending     = self._basic_auth_request(page, headers=headers, method=self.HTTP_POST, params=params)
+        elif http_method == self.HTTP_DELETE:
+            page        = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note)
+            pending     = self._basic_auth_request(page, method=self.HTTP_DELETE)
+        def check(response_data):
+            response, data = response_data
+            if response.status != 200:
+                raise SnapticError("Http error posting/editing/deleting note ", response.status, data)
+            self._clear_pages()
+            self._notify_write(http_method, note, data)
+            return data
+        return pending.then(check)
+
+    def _post_multi_part(self, host, selector, files):
+        content_type, body = self._encode_multi_part_form_data(files)
+        h = {
+            'User-Agent': 'INSERT USERAGENTNAME',
+            'Content-Type': content_type
+            }
+        #_AsyncHTTPRequest adds the Content-Length itself
+        def check(response_data):
+            response, data = response_data
+            if response.status != 200:
+                raise SnapticError("Error posting files ", response.status, data)
+            self._uploaded()
+            return data
+        return self._basic_auth_request(selector, method=self.HTTP_POST, headers=h, params=body,
+                                        host=host, port=httplib.HTTP_PORT, use_ssl=False).then(check)
+
+    def _close_after(self, result, fin):
+        #The body is streamed from fin by the event loop, close it once the upload finishes
+        result.add_callback(lambda finished: fin.close())
+
+    def _bulk(self, func, items, workers=None):
+        """
+        Run func on every item with at most workers requests in flight on the event loop.
+
+        Returns:
+            An AsyncResult for a list of func's results, or the SnapticError raised, in the order of items.
+        """
+        items       = list(items)
+        results     = [None] * len(items)
+        combined    = AsyncResult(self)
+        state       = dict(started=0, pending=len(items))
+
+        def launch():
+            i = state['started']
+            state['started'] += 1
+            try:
+                pending = func(items[i])
+            except Exception as e:
+                pending = AsyncResult(self)
+                pending.set_error(e)
+            pending.add_callback(lambda result: finish(i, result))
+
+        def finish(i, result):
+            if result._error is not None:
+                results[i] = _snaptic_error(result._error)
+            else:
+                results[i] = result._value
+            state['pending'] -= 1
+            if state['started'] < len(items):
+                launch()
+            elif state['pending'] == 0:
+                combined.set_result(results)
+
+        if not items:
+            combined.set_result(results)
+        for i in range(min(workers or self._pool_size, len(items))):
+            launch()
+        return combined
+
+    def get_user(self):
+        """
+        Get user info.
+
+        Returns:
+            An AsyncResult for a user object.
+        """
+        url = "/" + self.API_VERSION + self.API_ENDPOINT_USER_JSON
+        return self._coalesced('user', lambda: self._fetch_url(url).then(self._parse_user_info))
+
+    def _coalesced(self, key, func):
+        """
+        Share the AsyncResult of a request for the same key which is still running on the event loop.
+        """
+        pending = self._in_flight.get(key)
+        if pending is None or pending.done():
+            pending = self._in_flight[key] = func()
+        return pending
+
+    def _parse_notes_async(self, pending):
+        """
+        Parse notes once both they and, if not known yet, the user have been fetched.
+        The user request runs concurrently with the notes request.
+        """
+        return self._with_user(pending).then(self._parse_notes)
+
+    def _with_user(self, pending):
+        """
+        An AsyncResult for the value of pending which is only done once the user is known too.
+        """
+        if self._user is not None:
+            return pending
+        combined = AsyncResult.gather(self, [pending, self.get_user()])
+        return combined.then(lambda values: values[0])
+
+    def _resolved(self, value):
+        """
+        An AsyncResult which is already done with value.
+        """
+        result = AsyncResult(self)
+        result.set_result(value)
+        return result
 
-    def _request(self, http_method, note): #Clean this up a little -htormey
+    def get_page(self, cursor_position, lazy=False, refresh=False):
         """
-        Perform a http request on a note.
+        Get the notes and cursor information of a cursor position with one
+        request, answered from the Api's PageCache if it has one holding the page.
 
-        Args:
-            http_metod: what kind of http request is being made (i.e POST/DELETE/GET)
         Returns:
-            The server's response page.
+            An AsyncResult for a Page object.
         """
-        if http_method == self.HTTP_POST:
-            headers     = { 'Content-type' : "application/x-www-form-urlencoded" }
-            if isinstance(note, Note):
-                #Edit an existing note
-                params         = urlencode(note.dictionary)
-                page           = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note.note_id) + '.json'
-            else:
-                params      = urlencode(dict(text=note))
-                page        = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
-            handle      = self._basic_auth_request(page, headers=headers, method=self.HTTP_POST, params=params)
-        elif http_method == self.HTTP_DELETE:
-            page            = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES + str(note)
-            handle         = self._basic_auth_request(page, method=self.HTTP_DELETE)
- 
-        response    = handle.getresponse()
-        data        = response.read()
-        handle.close()
-
-        if response.status != 200:
-            raise SnapticError("Http error posting/editing/deleting note ", response.status, data)
-        return data
+        url     = self._cursor_url(cursor_position)
+        key     = (self._cache_key(url), lazy)
+        if not refresh and self._pages is not None:
+            page = self._pages.get(key)
+            if page is not None:
+                return self._resolved(page)
+        def store(source):
+            page = self._parse_page(cursor_position, source, lazy)
+            if self._pages is not None:
+                self._pages.set(key, page)
+            return page
+        return self._with_user(self._fetch_url(url)).then(store)
 
-    def get_image_with_id(self, id):
+    def get_tag_list(self):
         """
-        Get image data associated with a given id.
+        Fetch the tags of the users account from the server.
 
-        Args:
-            id: id of image to be fetched.
         Returns:
-            Data associated with image id.
+            An AsyncResult for a list of Tag objects.
         """
-        url = self.API_ENDPOINT_IMAGES_VIEW  + str(id)
-        return self._fetch_url(url)
+        url = "/" + self.API_VERSION + self.API_ENDPOINT_TAGS_JSON
+        return self._coalesced('tag_list', lambda: self._fetch_url(url).then(self._parse_tags))
 
-    def get_user_id(self):
+    def iter_notes(self, start_cursor=-1, prefetch=2):
         """
-        Get ID of API user.
-
-        Returns: 
-            Id of snaptic user associated with API instance.
+        Not supported, it would block on every page. Follow next_cursor with get_page instead.
         """
-        if self._user:
-            return self._user.id
-        else:
-            raise SnapticError("Error user id not set, try calling GetNotes.")
-
-    @Property
-    def notes():
-        doc = "A parsed list of note objects"
-        def fget(self):
-            if self._notes:
-                return self._notes
-            else:
-                return self.get_notes()
-        return locals()
+        raise SnapticError("iter_notes is not supported by AsyncApi, use get_page")
 
     def get_notes(self):
         """
         Get notes and update the Api's internal cache.
 
         Returns:
-            A list of Note objects from the snaptic users account.
+            An AsyncResult for a list of Note objects from the snaptic users account.
         """
-        url          = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
-        json_notes   = self._fetch_url(url)
-        self._notes  = self._parse_notes(json_notes)
-        return self._notes
+        url = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+        def store(notes):
+            self._store_notes(notes)
+            return notes
+        return self._coalesced('notes', lambda: self._parse_notes_async(self._fetch_url(url)).then(store))
 
     def get_notes_from_cursor(self, cursor_position):
         """
-        Get a batch of upto 20 notes from a given cursor position. See
-        description given for json_cursor for further details on how 
-        cursors work with snaptic.
+        Get a batch of upto 20 notes from a given cursor position.
 
-        Args:
-            cursor_position: cursor position to grab 20 notes from (i.e -1 is most recent 20)
         Returns:
-            A list of note objects based on the contents of the users account.
+            An AsyncResult for a list of note objects.
         """
-        json_notes   = self.json_cursor(cursor_position)
-        notes  = self._parse_notes(json_notes)
-        return notes
+        return self._parse_notes_async(self.json_cursor(cursor_position))
 
     def get_cursor_information(self, cursor_position):
         """
-        Gets information about cursor at a given position. See json_cursor for further 
-        details on how cursors work with snaptic.
+        Gets information about cursor at a given position.
 
-        Args:
-            cursor_position: cursor position you want to find out about.
         Returns:
-            A dictionary containing previous_cursor, next_cursor and note count.
+            An AsyncResult for a dictionary containing previous_cursor, next_cursor and note count.
         """
-        json_notes   = self.json_cursor(cursor_position)
-        return self._parse_cursor_info(json_notes)
+        return self.json_cursor(cursor_position).then(self._parse_cursor_info)
 
-    def _parse_cursor_info(self, source):
+    def get_json(self):
         """
-        Parse cursor information with notes returned from snaptic.
+        Get json object and update the cache.
+
+        Returns:
+            An AsyncResult for a json object representing all notes in a users account.
+        """
+        url = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
+        def store(data):
+            self._store_json(data)
+            return data
+        return self._coalesced('json', lambda: self._fetch_url(url).then(store))
+
+class NoteStore(object):
+    """
+    A local SQLite mirror of a snaptic account's notes, images and tags.
+
+    sync() walks cursor pages from the newest one and stops at the first page
+    whose notes are all older than the newest modified_at already stored, so
+    only changed notes are downloaded and written. Notes deleted on the server
+    are removed by reconcile(), which sync() runs every reconcile_interval
+    seconds.
+
+       Example usage:
 
+           >>> store = snaptic.NoteStore("notes.db")
+           >>> store.sync(api)
+           3
+           >>> [n.text for n in store.notes()][:2]
+           ['Harry says snaptic is da bomb #food #ice', 'Harry says snaptic is da bomb #food #ice']
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            note_id     INTEGER PRIMARY KEY,
+            created_at  TEXT,
+            modified_at TEXT,
+            reminder_at TEXT,
+            text        TEXT,
+            summary     TEXT,
+            source      TEXT,
+            source_url  TEXT,
+            user        INTEGER,
+            children    INTEGER,
+            location    TEXT
+        );
+        CREATE INDEX IF NOT EXISTS notes_modified_at ON notes (modified_at);
+        CREATE TABLE IF NOT EXISTS images (
+            note_id     INTEGER,
+            position    INTEGER,
+            id          INTEGER,
+            type        TEXT,
+            md5         TEXT,
+            revision_id INTEGER,
+            width       INTEGER,
+            height      INTEGER,
+            src         TEXT,
+            PRIMARY KEY (note_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            note_id     INTEGER,
+            position    INTEGER,
+            name        TEXT,
+            PRIMARY KEY (note_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS tags_name ON tags (name);
+        CREATE TABLE IF NOT EXISTS meta (
+            key         TEXT PRIMARY KEY,
+            value       TEXT
+        );
+    """
+
+    def __init__(self, path, reconcile_interval=24 * 60 * 60):
+        """
         Args:
-            source: A json object consisting of notes and cursor information
+            path: filename of the SQLite database, ':memory:' for a temporary store.
+            reconcile_interval: number of seconds between passes removing notes deleted on the server.
+        """
+        if sqlite3 is None:
+            raise SnapticError("NoteStore requires the sqlite3 module")
+        self._db                    = sqlite3.connect(path)
+        self._reconcile_interval    = reconcile_interval
+        self._db.executescript(self.SCHEMA)
+
+    def _get_meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def high_water(self):
+        """
         Returns:
-            A dictionary containing previous_cursor, next_cursor and note count.
+            The newest modified_at of any stored note, or None for an empty store.
         """
-        cursor_info   = json.loads(source)
-        if 'next_cursor' in cursor_info and 'previous_cursor' in cursor_info and 'count' in cursor_info:
-            return {"previous_cursor": cursor_info['previous_cursor'], "next_cursor": cursor_info['next_cursor'], "count": cursor_info['count'] }
-        else:
-            SnapticError("Error keys missing from source JSON passed to _parse_cursor_info")
+        return self._get_meta('high_water')
 
-    def get_user(self):
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def sync(self, api, reconcile=None):
         """
-        Get user info.
+        Bring the store up to date with the account behind api.
 
+        Args:
+            api: snaptic.Api instance for the account.
+            reconcile: True/False to force or skip removing deleted notes, None to do it when reconcile_interval has passed.
         Returns:
-            A user object.
+            The number of notes written.
         """
-        url          = "/" + self.API_VERSION + self.API_ENDPOINT_USER_JSON
-        user_info    = self._fetch_url(url)
-        self._parse_user_info(user_info)
-        return self._user
+        high_water  = self.high_water
+        newest      = high_water
+        written     = 0
+        cursor      = -1
+        try:
+            while cursor:
+                notes, cursor = api._fetch_page(cursor)
+                changed = [n for n in notes if high_water is None or n.modified_at > high_water or
+                           (n.modified_at == high_water and self._stored_modified_at(n.note_id) != n.modified_at)]
+                if notes and not changed:
+                    break
+                for note in changed:
+                    self._upsert(note)
+                    if newest is None or note.modified_at > newest:
+                        newest = note.modified_at
+                written += len(changed)
+            if newest is not None:
+                self._set_meta('high_water', newest)
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
 
-    @Property
-    def json():
-        doc = "Json object of notes stored in account."
-        def fget(self):
-            if self._json:
-                return self._json #should I return json.load(sef._json) ? -htormey
-            else:
-                return self.get_json()
-        return locals()
+        if reconcile is None:
+            last        = float(self._get_meta('last_reconcile', 0))
+            reconcile   = time.time() - last >= self._reconcile_interval
+        if reconcile:
+            self.reconcile(api)
+        return written
 
-    def get_json(self):
+    def reconcile(self, api):
         """
-        Get json object and update the cache.
+        Remove notes which no longer exist on the server. Every note id is
+        streamed from the account, but note bodies are not written.
 
+        Args:
+            api: snaptic.Api instance for the account.
         Returns:
-            A json object representing all notes in a users account.
+            The number of notes removed.
         """
-        url         = "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON
-        self._json  = self._fetch_url(url)
-        return self._json
+        live        = set(note.note_id for note in api.stream_notes())
+        stored      = [row[0] for row in self._db.execute("SELECT note_id FROM notes")]
+        removed     = [note_id for note_id in stored if note_id not in live]
+        try:
+            for note_id in removed:
+                self.delete(note_id)
+            self._set_meta('last_reconcile', repr(time.time()))
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        return len(removed)
 
-    def get_tags(self):
+    def _stored_modified_at(self, note_id):
+        #Notes modified in the same instant as the high water mark are only new if not stored yet
+        row = self._db.execute("SELECT modified_at FROM notes WHERE note_id = ?", (note_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _upsert(self, note):
+        self._db.execute("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (note.note_id, note.created_at, note.modified_at, note.reminder_at, note.text,
+                          note.summary, note.source, note.source_url, note.user, note.children,
+                          json.dumps(note.location)))
+        self._db.execute("DELETE FROM images WHERE note_id = ?", (note.note_id,))
+        self._db.execute("DELETE FROM tags WHERE note_id = ?", (note.note_id,))
+        self._db.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(note.note_id, position, image.id, image.type, image.md5, image.revision_id,
+                               image.width, image.height, image.src)
+                              for position, image in enumerate(note.media)])
+        self._db.executemany("INSERT INTO tags VALUES (?, ?, ?)",
+                             [(note.note_id, position, tag) for position, tag in enumerate(note.tags)])
+
+    def put(self, note):
         """
-        Fetch json object containing tags from users account.
+        Store a note object, replacing any stored note with the same id.
+        """
+        self._upsert(note)
+        self._db.commit()
 
+    def delete(self, note_id):
+        """
+        Remove a note and its images and tags from the store.
+        """
+        for table in ('notes', 'images', 'tags'):
+            self._db.execute("DELETE FROM %s WHERE note_id = ?" % table, (note_id,))
+
+    def get(self, note_id):
+        """
         Returns:
-            A json object containing tags and related information (number of notes per tag, etc).
+            The stored note object with note_id, or None.
         """
-        url         = "/" + self.API_VERSION + self.API_ENDPOINT_TAGS_JSON
-        tags        = self._fetch_url(url)
-        return tags
+        notes = self._load("WHERE note_id = ?", (note_id,))
+        if notes:
+            return notes[0]
+        return None
 
-    def json_cursor(self, cursor_position):
+    def notes(self, tag=None):
         """
-        Get batches of 20 notes in JSON format from a given cursor position i.e -1, 1,
-        etc. For example: -1 returns the most recent 20 notes, 1 returns the previous 20
-        before that, etc. One exeption to note is that 0 returns a JSON object for all
-        notes in a given account.
+        Get stored notes, newest modified first.
 
         Args:
-            cursor_position: cursor position to grab 20 notes from (i.e -1 is most recent 20).
+            tag: only return notes with this tag.
         Returns:
-            A json object containing notes from cursor position requested.
+            A list of note objects.
         """
-        url         =  "/" + self.API_VERSION + self.API_ENDPOINT_NOTES_JSON + self.API_ENDPOINT_CURSOR + str(cursor_position)
-        cursor      = self._fetch_url(url)
-        return cursor
+        if tag is None:
+            return self._load("", ())
+        return self._load("WHERE note_id IN (SELECT note_id FROM tags WHERE name = ?)", (tag,))
 
-    def _fetch_url(self, url):
-        """
-        Perform a basic auth request on a given snaptic API endpoint.
+    def _load(self, where, args):
+        rows    = self._db.execute("SELECT * FROM notes %s ORDER BY modified_at DESC" % where, args).fetchall()
+        ids     = [row[0] for row in rows]
+        media   = dict((note_id, []) for note_id in ids)
+        tags    = dict((note_id, []) for note_id in ids)
+        if ids:
+            selected = "note_id IN (SELECT note_id FROM notes %s)" % where
+            for row in self._db.execute("SELECT note_id, type, md5, id, revision_id, width, height, src FROM images "
+                                        "WHERE %s ORDER BY note_id, position" % selected, args):
+                media[row[0]].append(Image(*row[1:]))
+            for row in self._db.execute("SELECT note_id, name FROM tags WHERE %s "
+                                        "ORDER BY note_id, position" % selected, args):
+                tags[row[0]].append(row[1])
+        return [Note(row[1], row[2], row[3], row[0], row[4], row[5], row[6], row[7], row[8], row[9],
+                     media[row[0]], tags[row[0]], _json_loads(row[10]))
+                for row in rows]
+
+    def close(self):
+        self._db.close()
+
+class NoteIndex(object):
+    """
+    An offline full-text index over the text and summary of notes, for
+    searching an account without going to the network. Queries are words,
+    which all have to match, optionally with a trailing * to match any
+    word starting with it, and "quoted phrases" whose words have to appear
+    in order. Results are ranked with BM25.
+
+    Register the index with Api.add_listener to keep it current as notes
+    are posted, edited and deleted, and call save() to persist it.
+
+       Example usage:
 
+           >>> index = snaptic.NoteIndex("notes.idx")
+           >>> index.update(api.get_notes())
+           >>> api.add_listener(index)
+           >>> [n.text for n in index.search('"da bomb" ice*')][:1]
+           ['Harry says snaptic is da bomb #food #ice']
+           >>> index.save()
+    """
+
+    TOKEN   = re.compile(r'\w+', re.UNICODE)
+    QUERY   = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+    #Summary words are numbered from here on so phrases never span text and summary
+    SUMMARY_OFFSET = 1 << 20
+    K1      = 1.2
+    B       = 0.75
+
+    def __init__(self, path=None):
+        """
         Args:
-            url: Snaptic Api endpoint (i.e /v1/notes.json etc).
+            path: file to save the index to, loaded now if it exists. None keeps it in memory only.
+        """
+        self._path      = path
+        self._lock      = threading.Lock()
+        self._postings  = {}
+        self._lengths   = {}
+        self._words     = {}
+        self._notes     = {}
+        self._terms     = None
+        self._total_length = 0
+        if path is not None and os.path.exists(path):
+            fin = open(path, 'rb')
+            try:
+                state = pickle.load(fin)
+            finally:
+                fin.close()
+            self._postings, self._lengths, self._notes = state['postings'], state['lengths'], state['notes']
+            self._words = state['words']
+            self._total_length = sum(self._lengths.values())
+
+    def __len__(self):
+        return len(self._notes)
+
+    def __contains__(self, note_id):
+        return note_id in self._notes
+
+    @classmethod
+    def tokenize(cls, text):
+        """
         Returns:
-            The server's response page.
+            The lower cased words of text.
         """
-        handler       = self._basic_auth_request(url)
-        response      = handler.getresponse()
-        data          = response.read()
-        handler.close()
-        if response.status != 200:
-            raise SnapticError("Http error", response.status, data)
-        return data
+        if not text:
+            return []
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return cls.TOKEN.findall(text.lower())
 
-    def _get_auth_headers(self):
+    def add(self, note):
         """
-        Switch between basic auth and cookie auth depending on which properties
-        self has.
+        Index a note, replacing the previously indexed version of it.
         """
-        if hasattr(self, "_username") and hasattr(self, "_password"):
-            return self._make_basic_auth_headers(self._username, self._password)
-        elif hasattr(self, "_cookie_epass"):
-            return self._make_cookie_auth_headers(self._cookie_epass)
-        else:
-            raise SnapticError("No username/password combination\
-                                or cookie authentication provided")
+        words = list(enumerate(self.tokenize(note.text)))
+        summary = note.summary
+        if summary and summary not in (note.text or ''):
+            words.extend((self.SUMMARY_OFFSET + i, word) for i, word in enumerate(self.tokenize(summary)))
+        positions = {}
+        for position, word in words:
+            positions.setdefault(word, []).append(position)
+        self._lock.acquire()
+        try:
+            self._remove(note.note_id)
+            for word, found in positions.items():
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = {}
+                    self._terms = None
+                postings[note.note_id] = tuple(found)
+            self._lengths[note.note_id] = len(words)
+            self._total_length         += len(words)
+            self._words[note.note_id]   = tuple(positions)
+            self._notes[note.note_id]   = note
+        finally:
+            self._lock.release()
 
-    def _make_basic_auth_headers(self, username, password):
+    def update(self, notes):
         """
-        Encode headers for basic auth request.
+        Index several notes, i.e the result of Api.get_notes().
+        """
+        for note in notes:
+            self.add(note)
 
-        Args::
+    def remove(self, note_id):
+        """
+        Drop a note from the index.
+        """
+        self._lock.acquire()
+        try:
+            self._remove(note_id)
+        finally:
+            self._lock.release()
 
-            username: snaptic username to be used.
-            password: password to be used.
+    def _remove(self, note_id):
+        #Caller must hold self._lock
+        #Use the words indexed at the time, the Note may have been edited in place since
+        words = self._words.pop(note_id, None)
+        if words is None:
+            return
+        self._total_length -= self._lengths.pop(note_id)
+        del self._notes[note_id]
+        for word in words:
+            postings = self._postings[word]
+            del postings[note_id]
+            if not postings:
+                del self._postings[word]
+                self._terms = None
 
-        Returns:
-            Dictionary with encoded basic auth values.
+    def note_saved(self, note):
+        self.add(note)
+
+    def note_deleted(self, note_id):
+        self.remove(note_id)
+
+    def search(self, query, limit=20):
         """
-        if username and password:
-            headers = dict(Authorization="Basic %s"
-                    %(base64.b64encode("%s:%s" %(username, password))))
-        else:
-            raise SnapticError("Error making basic auth headers with username: %s, password: %s" % (username, password))
-        return headers
+        Find notes matching every word, prefix* and "phrase" in query.
 
-    def _make_cookie_auth_headers(self, cookie_epass):
+        Args:
+            query: the search query.
+            limit: maximum number of notes to return, None for all.
+        Returns:
+            A list of matching Note objects, best match first.
         """
-        Encode headers for cookie auth request.
+        clauses = []
+        for phrase, word in self.QUERY.findall(query):
+            if phrase:
+                words = self.tokenize(phrase)
+                if words:
+                    clauses.append(('phrase', words))
+            elif word.endswith('*') and self.tokenize(word):
+                clauses.append(('prefix', self.tokenize(word)))
+            else:
+                clauses.extend(('word', [w]) for w in self.tokenize(word))
+        if not clauses:
+            return []
 
-        Args::
+        self._lock.acquire()
+        try:
+            count   = len(self._lengths)
+            average = count and float(self._total_length) / count
+            scores  = None
+            #Narrow down with the most selective clauses first, later ones only look at what is left
+            for kind, words in sorted(clauses, key=lambda clause: self._cost(*clause)):
+                matches = self._match(kind, words, scores)
+                if scores is None:
+                    scores = dict.fromkeys(matches, 0.0)
+                else:
+                    scores = dict((note_id, score) for note_id, score in scores.items() if note_id in matches)
+                if not scores:
+                    return []
+                for note_id in scores:
+                    scores[note_id] += self._score(matches[note_id], count, average, note_id)
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            if limit is not None:
+                ranked = ranked[:limit]
+            return [self._notes[note_id] for note_id, score in ranked]
+        finally:
+            self._lock.release()
 
-            cookie_epass: cookie auth token to be used.
+    def _expand(self, prefix):
+        """
+        Returns:
+            Every indexed word starting with prefix.
+        """
+        #Caller must hold self._lock
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        start = bisect.bisect_left(self._terms, prefix)
+        return list(itertools.takewhile(lambda term: term.startswith(prefix), itertools.islice(self._terms, start, None)))
 
+    def _cost(self, kind, words):
+        #Caller must hold self._lock
+        if kind == 'prefix':
+            return sum(len(self._postings[term]) for term in self._expand(words[-1]))
+        return min(len(self._postings.get(word, ())) for word in words)
+
+    def _match(self, kind, words, restrict=None):
+        """
+        Args:
+            kind: 'word', 'prefix' or 'phrase'.
+            words: the clause's words.
+            restrict: only consider these note ids, None for all.
         Returns:
-            Dictionary with encoded basic auth values.
+            A dictionary of note id to a list of (term frequency, document frequency) pairs for one query clause.
         """
-        if cookie_epass:
-            return {
-                "Cookie": "cookie_epass={0}".format(cookie_epass)
-            }
-        else:
-            raise SnapticError("Error making cookie auth headers with\
-                               cookie:{0}".format(cookie_epass))
+        #Caller must hold self._lock
+        def pairs(postings, into):
+            if restrict is not None and len(restrict) < len(postings):
+                found = ((note_id, postings.get(note_id)) for note_id in restrict)
+            else:
+                found = postings.iteritems()
+            for note_id, positions in found:
+                if positions and (restrict is None or note_id in restrict):
+                    into.setdefault(note_id, []).append((len(positions), len(postings)))
+            return into
 
-    def _basic_auth_request(self, path, method=HTTP_GET, headers={}, params={}):
+        if kind == 'word':
+            return pairs(self._postings.get(words[0], {}), {})
+        if kind == 'prefix':
+            matches = {}
+            for term in self._expand(words[-1]):
+                pairs(self._postings[term], matches)
+            #A prefix like "snap-sh*" tokenizes to several words, the earlier ones must match too
+            for word in words[:-1]:
+                postings = self._postings.get(word, {})
+                matches  = dict((note_id, found) for note_id, found in matches.items() if note_id in postings)
+            return matches
+        postings = [self._postings.get(word, {}) for word in words]
+        if not all(postings):
+            return {}
+        candidates  = set(restrict if restrict is not None else postings[0]).intersection(*postings)
+        found       = {}
+        for note_id in candidates:
+            later = [set(p[note_id]) for p in postings[1:]]
+            hits  = len([start for start in postings[0][note_id]
+                         if all(start + i + 1 in positions for i, positions in enumerate(later))])
+            if hits:
+                found[note_id] = hits
+        return dict((note_id, [(hits, len(found))]) for note_id, hits in found.items())
+
+    def _score(self, pairs, count, average, note_id):
+        #BM25 over (term frequency, document frequency) pairs
+        length  = self._lengths[note_id]
+        score   = 0.0
+        for frequency, documents in pairs:
+            idf     = math.log(1 + (count - documents + 0.5) / (documents + 0.5))
+            score  += idf * frequency * (self.K1 + 1) / (frequency + self.K1 * (1 - self.B + self.B * length / (average or 1)))
+        return score
+
+    def save(self, path=None):
         """
-        Make a HTTP request with basic auth header and supplied method.
-        Defaults to operating over SSL. 
+        Write the index to disk atomically.
 
-        Args::
+        Args:
+            path: file to write to, defaults to the path the index was opened with.
+        """
+        path = path or self._path
+        if path is None:
+            raise SnapticError("NoteIndex has no path to save to")
+        self._lock.acquire()
+        try:
+            state = dict(postings=self._postings, lengths=self._lengths, words=self._words, notes=self._notes)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                fout = os.fdopen(fd, 'wb')
+                try:
+                    pickle.dump(state, fout, 2)
+                finally:
+                    fout.close()
+                _rename(tmp, path)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        finally:
+            self._lock.release()
 
-            path: Snaptic API endpoint
-            metthod: which http method to use (PUT/DELETE/GET)
-            headers: Additional header to use with request.
-            params: Other parameters to use
+class TagIndex(object):
+    """
+    An in-memory index from tag name to the ids of the notes carrying it.
+    Tag counts and tag filters are answered from it without going to the
+    network. Api.tag_index builds one from the account's notes and keeps it
+    current as notes are posted, edited and deleted through the Api.
 
-        Returns:
-            The server's response page.
+       Example usage:
+
+           >>> index = api.tag_index
+           >>> index.tags()
+           [<Tag u'food' count=2>, <Tag u'ice' count=2>]
+           >>> [n.text for n in index.notes('food', 'ice')][:1]
+           ['Harry says snaptic is da bomb #food #ice']
+    """
+
+    def __init__(self, notes=()):
         """
-        h = self._get_auth_headers()
-        h.update(headers)
-        if self._use_ssl:
-            handler = httplib.HTTPSConnection
-        else:
-            handler = httplib.HTTPConnection
+        Args:
+            notes: notes to index, i.e the result of Api.get_notes().
+        """
+        self._lock      = threading.Lock()
+        self._note_ids  = {}
+        self._tags      = {}
+        self._notes     = {}
+        self.update(notes)
 
-        # 'timeout' parameter is only available in Python 2.6+
-        if sys.version_info[:2] < (2, 6):
-            conn = handler(self._url, self._port)
-        else:
-            conn = handler(self._url, self._port, timeout=self._timeout)
-        conn.request(method, path, params, headers=h)
-        return conn
+    def __len__(self):
+        return len(self._note_ids)
 
-    def _parse_user_info(self, source):
+    def __contains__(self, tag):
+        return tag in self._note_ids
+
+    def add(self, note):
         """
-        Parse JSON user returned from snaptic, instantiate a User object from it.
+        Index a note's tags, replacing those of the previously indexed version of it.
+        """
+        self._lock.acquire()
+        try:
+            self._add(note.note_id, note.tags, note)
+        finally:
+            self._lock.release()
 
-        Args:
-            source: Json object representing a user
-        Returns:
-            A User object.
+    def _add(self, note_id, tags, note):
+        #Caller must hold self._lock. note is a Note, or a (LazyNotes, index) pair it is built from when needed.
+        self._remove(note_id)
+        tags = tuple(set(tags or ()))
+        for tag in tags:
+            self._note_ids.setdefault(tag, set()).add(note_id)
+        self._tags[note_id]     = tags
+        self._notes[note_id]    = note
+
+    def update(self, notes):
+        """
+        Index several notes. The notes of a LazyNotes are indexed from their
+        records and only built when notes() returns them.
         """
-        user_info   = json.loads(source)
+        if not isinstance(notes, LazyNotes):
+            for note in notes:
+                self.add(note)
+            return
+        self._lock.acquire()
+        try:
+            for i in xrange(len(notes)):
+                record = notes.record(i)
+                self._add(record['id'], record.get('tags'), (notes, i))
+        finally:
+            self._lock.release()
 
-        if 'user' in user_info:
-            self._user = User(user_info['user']['id'], user_info['user']['user_name'], user_info['user']['created_at'], user_info['user']['email'])
-        else:
-            SnapticError("Error no user key found in source JSON passed to _parse_user_info")
+    def rebuild(self, notes):
+        """
+        Replace everything in the index with notes.
+        """
+        self._lock.acquire()
+        try:
+            self._note_ids.clear()
+            self._tags.clear()
+            self._notes.clear()
+        finally:
+            self._lock.release()
+        self.update(notes)
 
-    def _parse_notes( self, source, get_image_data=False):
+    def remove(self, note_id):
         """
-        parse JSON notes returned from snaptic, instantiate a list of note objects from it.
+        Drop a note from the index.
+        """
+        self._lock.acquire()
+        try:
+            self._remove(note_id)
+        finally:
+            self._lock.release()
 
-        Args::
+    def _remove(self, note_id):
+        #Caller must hold self._lock. Uses the tags indexed at the time, the Note may have been edited in place.
+        for tag in self._tags.pop(note_id, ()):
+            note_ids = self._note_ids[tag]
+            note_ids.discard(note_id)
+            if not note_ids:
+                del self._note_ids[tag]
+        self._notes.pop(note_id, None)
 
-            source: A json object representing a list of notes.
-            get_images: if images are associated with notes, download them now.
+    def note_saved(self, note):
+        self.add(note)
+
+    def note_deleted(self, note_id):
+        self.remove(note_id)
+
+    def tags(self):
+        """
         Returns:
-            A list of note objects.
+            A list of Tag objects with the number of notes carrying each, sorted by name.
         """
+        self._lock.acquire()
+        try:
+            return [Tag(tag, len(note_ids)) for tag, note_ids in sorted(self._note_ids.items())]
+        finally:
+            self._lock.release()
 
-        notes       = []
-        json_notes  = json.loads(source)
+    def count(self, tag):
+        """
+        Returns:
+            The number of notes carrying tag.
+        """
+        return len(self._note_ids.get(tag, ()))
 
-        for note in json_notes['notes']:
-            media           = []
-            location        = []
-            tags            = []
-            user            = None
-            source          = None
+    def note_ids(self, *tags):
+        """
+        Returns:
+            A set of the ids of notes carrying every one of tags.
+        """
+        self._lock.acquire()
+        try:
+            sets = sorted((self._note_ids.get(tag, set()) for tag in tags), key=len)
+            if not sets:
+                return set()
+            return sets[0].intersection(*sets[1:])
+        finally:
+            self._lock.release()
 
-            if 'id' in note:
-                if 'user' in note:
-                    if self._user == None:
-                        self. get_user()
-                        user = self._user.id
-                    user = self._user.id
-                if 'location' in note:
-                    pass 
-                if 'tags' in note:
-                    for tag in note['tags']:
-                        tags.append(tag)
-                if 'media' in note:
-                    for item in note['media']:
-                        if item['type'] == 'image':
-                            image_data = None
-                            if get_image_data:
-                                image_data = self._fetch_url(item['src'])
-                            media.append(Image(item['type'], None, item['id'], item['revision_id'], item['width'], item['height'], item['src'], image_data))
-
-                notes.append(Note(note['created_at'], note['modified_at'], note['reminder_at'], note['id'], note['text'], note['summary'], note['source'], 
-                                note['source_url'], user, note['children'], media, tags, location))
-        return notes
+    def notes(self, *tags):
+        """
+        Returns:
+            A list of the Note objects carrying every one of tags, ordered by note id.
+        """
+        note_ids = self.note_ids(*tags)
+        self._lock.acquire()
+        try:
+            notes = []
+            for note_id in sorted(note_ids):
+                note = self._notes.get(note_id)
+                if isinstance(note, tuple):
+                    lazy, index = note
+                    note = self._notes[note_id] = lazy[index]
+                if note is not None:
+                    notes.append(note)
+            return notes
+        finally:
+            self._lock.release()
@@ -0,0 +1,265 @@
+# Copyright (c) 2010 Harry Tormey <harry@snaptic.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+'''Offline benchmarks for the snaptic library.
+
+Run from the tests directory:
+
+    $ python benchmark.py memory --notes 100000
+    $ python benchmark.py micro --notes 20,1000,100000 --save-baseline
+    $ python benchmark.py micro --notes 20,1000,100000
+'''
+
+import gc
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+
+# backwards compatible with Python < 2.6
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import snaptic
+
+
+def make_notes_json(count, images=1000):
+    """
+    Build a synthetic /v1/notes.json document. Every fifth note carries an
+    image drawn from a pool of images, so some media ids repeat.
+    """
+    notes = []
+    for i in xrange(count):
+        note = {
+            "id": i, "created_at": "2010-03-08T17:49:08.850Z", "modified_at": "2010-03-08T17:49:08.850Z",
+            "reminder_at": None, "text": "post number %d #food #ice" % i, "summary": "post number %d" % i,
+            "source": "3banana", "source_url": "https://snaptic.com/", "children": 0,
+            "user": {"user_name": "harry12", "id": 1813083}, "tags": ["food", "ice"], "location": None,
+            "mode": "private",
+        }
+        if i % 5 == 0:
+            image_id = i % images
+            note["media"] = [{"type": "image", "id": image_id, "revision_id": 1, "width": 640, "height": 480,
+                              "src": "/viewImage.action?viewNodeId=%d" % image_id, "md5": "%032x" % image_id}]
+        notes.append(note)
+    return json.dumps({"notes": notes})
+
+def make_cursor_json(count):
+    """
+    A notes.json page carrying cursor information, as returned for ?cursor=N.
+    """
+    page = json.loads(make_notes_json(count))
+    page.update(previous_cursor=-1, next_cursor=count, count=count)
+    return json.dumps(page)
+
+def make_user_json():
+    return json.dumps({"user": {"id": 1813083, "user_name": "harry12", "created_at": "2010-01-01T00:00:00.000Z",
+                                "email": "harry@snaptic.com"}})
+
+def make_image(size):
+    """
+    size bytes of image-like data which does not compress.
+    """
+    return os.urandom(size)
+
+def make_api():
+    """
+    An Api which never touches the network for the user lookup in _parse_notes.
+    """
+    api         = snaptic.Api("username", "password")
+    api._user   = snaptic.User(1813083, "harry12", "2010-01-01T00:00:00.000Z", "harry@snaptic.com")
+    return api
+
+def rss():
+    """
+    Resident set size of this process in bytes.
+    """
+    for line in open("/proc/self/status"):
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not available, the memory benchmark needs Linux /proc")
+
+def _unslotted(cls):
+    """
+    Copy of a model class without __slots__, i.e. one instance __dict__ per object.
+    """
+    slots = set(getattr(cls, '__slots__', ())) | set(['__slots__', '__weakref__', '__dict__'])
+    attrs = dict((k, v) for k, v in vars(cls).items() if k not in slots)
+    return type(cls.__name__, (object,), attrs)
+
+class _NoSharing(dict):
+    def setdefault(self, key, value):
+        return value
+
+def memory_child(count, mode):
+    source  = make_notes_json(count)
+    api     = make_api()
+    if mode == "baseline":
+        snaptic.Note    = _unslotted(snaptic.Note)
+        snaptic.Image   = _unslotted(snaptic.Image)
+        api._shared_strings = _NoSharing()
+        api._shared_image   = lambda item: snaptic.Image(item['type'], None, item['id'], item['revision_id'],
+                                                         item['width'], item['height'], item['src'])
+    gc.collect()
+    before  = rss()
+    notes   = api._parse_notes(source)
+    del source
+    gc.collect()
+    used    = rss() - before
+    sys.stdout.write("%d\n" % used)
+
+def memory(options):
+    """
+    Parse options.notes synthetic notes in a fresh interpreter per model
+    variant and report the resident memory each Note list costs.
+    """
+    results = {}
+    for mode in ("baseline", "compact"):
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "memory-child",
+                                  "--notes", str(options.notes), "--mode", mode], stdout=subprocess.PIPE)
+        out, _ = child.communicate()
+        if child.returncode != 0:
+            raise SystemExit(child.returncode)
+        results[mode] = int(out)
+    print("%d notes" % options.notes)
+    for mode in ("baseline", "compact"):
+        print("  %-8s %8.1f MB  %6.0f bytes/note" % (mode, results[mode] / 1048576.0,
+                                                     results[mode] / float(options.notes)))
+    print("  saving   %7.1f%%" % (100.0 * (results["baseline"] - results["compact"]) / results["baseline"]))
+
+def allocations(func):
+    """
+    Run func once and count what it allocates: bytes with tracemalloc where
+    the interpreter has it, otherwise the number of new gc-tracked objects
+    still alive when func returns.
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        result  = func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, "bytes"
+    before  = len(gc.get_objects())
+    result  = func()
+    return len(gc.get_objects()) - before, "objects"
+
+def timeit(func, min_time):
+    """
+    Best wall time of one call to func, repeating for at least min_time seconds.
+    """
+    best, spent = None, 0.0
+    while spent < min_time or best is None:
+        start   = time.time()
+        func()
+        elapsed = time.time() - start
+        spent  += elapsed
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def micro_cases(options):
+    """
+    Yield (name, work, unit, func) for every microbenchmark, where func does
+    work units of unit per call.
+    """
+    api = make_api()
+    for count in options.notes:
+        source = make_notes_json(count)
+        yield "_parse_notes/%d" % count, count, "notes", lambda source=source: api._parse_notes(source)
+        cursor = make_cursor_json(count)
+        yield "_parse_cursor_info/%d" % count, count, "notes", lambda cursor=cursor: api._parse_cursor_info(cursor)
+        notes  = api._parse_notes(source)
+        yield "Note.dictionary/%d" % count, count, "notes", lambda notes=notes: [n.dictionary for n in notes]
+        del source, cursor, notes
+    user = make_user_json()
+    yield "_parse_user_info", 1000, "calls", lambda: [api._parse_user_info(user) for i in xrange(1000)]
+    yield "_get_auth_headers", 10000, "calls", lambda: [api._get_auth_headers() for i in xrange(10000)]
+    for size in options.images:
+        image = make_image(size)
+        def encode(image=image):
+            content_type, body = api._encode_multi_part_form_data([("image", "image.jpg", image)])
+            while body.read(65536):
+                pass
+        yield "_encode_multi_part_form_data/%d" % size, size / 1048576.0, "MB", encode
+
+def load_baseline(path):
+    try:
+        return json.load(open(path))
+    except IOError:
+        return {}
+
+def micro(options):
+    """
+    Time every microbenchmark, print throughput and allocations, and compare
+    with (or save) the baseline in options.baseline.
+    """
+    baseline = load_baseline(options.baseline)
+    results  = {}
+    print("%-36s %12s %14s %16s %9s" % ("benchmark", "time", "throughput", "allocated", "vs base"))
+    for name, work, unit, func in micro_cases(options):
+        best            = timeit(func, options.min_time)
+        allocated, kind = allocations(func)
+        results[name]   = dict(seconds=best, allocated=allocated)
+        change = ""
+        if name in baseline:
+            change = "%+8.1f%%" % (100.0 * (best - baseline[name]["seconds"]) / baseline[name]["seconds"])
+        print("%-36s %10.3fms %9.0f %-4s %9d %-6s %9s" % (name, best * 1000, work / best, unit + "/s",
+                                                          allocated, kind, change))
+    if options.save_baseline:
+        baseline.update(results)
+        json.dump(baseline, open(options.baseline, "w"), indent=1, sort_keys=True)
+        print("baseline saved to %s" % options.baseline)
+
+def _sizes(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(v) for v in value.split(",")])
+
+def main(argv):
+    parser = OptionParser(usage="%prog memory [--notes N] | micro [--notes N,N,..] [--images BYTES,..] [--save-baseline]")
+    parser.add_option("--notes", type="string", action="callback", callback=_sizes, default=None,
+                      help="number of synthetic notes, comma separated for micro (default 20,1000,100000)")
+    parser.add_option("--images", type="string", action="callback", callback=_sizes, default=[4096, 4194304],
+                      help="image sizes in bytes for micro, comma separated (default 4096,4194304)")
+    parser.add_option("--min-time", type="float", default=0.5, help="seconds to repeat each micro benchmark for")
+    parser.add_option("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "benchmark_baseline.json"),
+                      help="baseline file micro compares against")
+    parser.add_option("--save-baseline", action="store_true", default=False,
+                      help="store this run's micro results as the baseline")
+    parser.add_option("--mode", default="compact", help=SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+    if args == ["micro"]:
+        options.notes = options.notes or [20, 1000, 100000]
+        micro(options)
+        return
+    options.notes = (options.notes or [100000])[0]
+    if args == ["memory"]:
+        memory(options)
+    elif args == ["memory-child"]:
+        memory_child(options.notes, options.mode)
+    else:
+        parser.error("unknown benchmark %s" % " ".join(args))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
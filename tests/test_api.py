@@ -3,7 +3,12 @@ try:
     import json
 except ImportError:
     import simplejson as json
+import os
+import pickle
+import socket
 import sys
+import tempfile
+import threading
 
 from nose.tools import assert_equals, assert_true
 from testconfig import config
@@ -137,3 +142,481 @@ def test_post_note_json_schema_valid():
             assert_true(field in note)
 
 
+def test_connection_reuse():
+    """
+    Verify that consecutive requests share one keep-alive connection.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    api.get_user()
+    api.get_tags()
+    api.get_notes_from_cursor(-1)
+    stats = api.get_pool_stats().values()[0]
+    assert_equals(stats['created'], 1)
+    assert_equals(stats['reused'], 2)
+    api.close()
+    assert_equals(api.get_pool_stats().values()[0]['idle'], 0)
+
+def test_async_get_notes_from_cursor():
+    """
+    Verify that AsyncApi fetches several cursor pages concurrently and parses them like Api.
+    """
+    cfg = config["api"]
+    api = snaptic.AsyncApi(username=cfg['email'], password=cfg['password'],
+                           url=cfg["host"])
+    pages = [api.get_notes_from_cursor(-1), api.json_cursor(-1)]
+    api.run()
+    notes = pages[0].result()
+    data  = json.loads(pages[1].result())
+    assert_equals([n.note_id for n in notes], [n['id'] for n in data['notes']])
+
+def test_iter_notes():
+    """
+    Verify that iter_notes walks every cursor page and yields the same notes as get_notes.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    all_ids     = [n.note_id for n in api.get_notes()]
+    iter_ids    = [n.note_id for n in api.iter_notes(prefetch=2)]
+    assert_equals(sorted(all_ids), sorted(iter_ids))
+    assert_equals(iter_ids[:20], [n.note_id for n in api.get_notes_from_cursor(-1)])
+
+def test_stream_notes():
+    """
+    Verify that stream_notes yields the same notes as get_notes.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    streamed    = [n.note_id for n in api.stream_notes(chunk_size=512)]
+    assert_equals(streamed, [n.note_id for n in api.get_notes()])
+
+def test_parse_notes_image_data():
+    """
+    Verify that image data fetched concurrently by _parse_notes matches get_image_with_id.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"], image_workers=4)
+    notes   = api._parse_notes(api.get_json(), get_image_data=True)
+    images  = [image for note in notes for image in note.media]
+    for image in images[:3]:
+        assert_equals(image.data, api._fetch_url(image.src))
+    assert_true(all(image.data is not None for image in images))
+
+def test_encode_multi_part_form_data_streams_files():
+    """
+    Verify that a multipart body built from a file object matches the in-memory encoding and reports its length.
+    """
+    from StringIO import StringIO
+    api = snaptic.Api(username="user", password="pass")
+    content_type, body = api._encode_multi_part_form_data([("image", "a.jpg", StringIO("\xff\xd8 image data"))])
+    boundary = content_type.split("boundary=")[1]
+    expected = "\r\n".join(['--' + boundary,
+                            'Content-Disposition: form-data; name="image"; filename="a.jpg"',
+                            'Content-Type: image/jpeg', '', "\xff\xd8 image data",
+                            '--' + boundary + '--', ''])
+    assert_equals(len(body), len(expected))
+    assert_equals(body.read(7) + body.read(), expected)
+
+def test_response_cache():
+    """
+    Verify that a cached Api serves unchanged notes without decoding them again, as fresh Note objects.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"], cache=snaptic.ResponseCache())
+    first   = api.get_notes()
+    text    = first[0].text
+    first[0].text = "local edit"
+    second  = api.get_notes()
+    assert_equals([n.note_id for n in first], [n.note_id for n in second])
+    assert_equals(second[0].text, text)
+    assert_equals(api.metrics.snapshot()['json_parse']['notes']['count'], 1)
+    assert_equals(api.get_json(), api.get_json())
+
+def test_note_store_sync():
+    """
+    Verify that NoteStore mirrors every note and that a second sync with no changes writes nothing.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    store = snaptic.NoteStore(":memory:")
+    store.sync(api, reconcile=False)
+    assert_equals(len(store), len(api.get_notes()))
+    assert_equals(store.sync(api, reconcile=True), 0)
+    note = api.notes[0]
+    assert_equals(store.get(note.note_id).text, note.text)
+
+def test_parse_notes_shares_images():
+    """
+    Verify that notes referencing the same image revision share one Image and keep the Note interface.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    api._user = snaptic.User(1, "user", "2010-01-01T00:00:00.000Z", "user@example.com")
+    media = [{"type": "image", "id": 7, "revision_id": 2, "width": 1, "height": 1, "src": "/img/7"}]
+    note  = {"created_at": "c", "modified_at": "m", "reminder_at": None, "text": "t", "summary": "s",
+             "source": "3banana", "source_url": "https://snaptic.com/", "user": {"id": 1}, "children": 0,
+             "tags": ["food"], "location": None, "media": media}
+    notes = api._parse_notes(json.dumps({"notes": [dict(note, id=1), dict(note, id=2)]}))
+    assert_true(notes[0].media[0] is notes[1].media[0])
+    assert_true(notes[0].has_media)
+    assert_equals(notes[1].dictionary, dict(text="t"))
+    assert_equals(notes[1].tags, ["food"])
+    assert_true(not hasattr(notes[0], "__dict__"))
+    copies = pickle.loads(pickle.dumps(notes))
+    assert_equals(copies[1].dictionary, dict(text="t"))
+    assert_true(copies[0].media[0] is copies[1].media[0])
+
+def test_get_notes_lazy():
+    """
+    Verify that lazily built notes match the eagerly parsed ones.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    eager   = api.get_notes()
+    lazy    = api.get_notes(lazy=True)
+    assert_equals(len(lazy), len(eager))
+    assert_equals([n.note_id for n in lazy[:3]], [n.note_id for n in eager[:3]])
+    assert_true(lazy[0] is lazy[:1][0])
+    assert_equals(lazy[-1].text, eager[-1].text)
+
+def test_bulk_post_and_delete_notes():
+    """
+    Verify bulk posting and deleting notes, and that a failing item is reported without stopping the batch.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    data_before_post = test_get_notes()
+    results = api.post_notes(["Bulk testing %d" % i for i in range(5)], workers=3)
+    ids     = [json.loads(r)['notes'][0]['id'] for r in results]
+    assert_equals(len(data_before_post) + 5, len(test_get_notes()))
+    results = api.delete_notes(ids + [0])
+    assert_true(isinstance(results[-1], snaptic.SnapticError))
+    assert_equals(len(data_before_post), len(test_get_notes()))
+
+def test_write_behind_coalesces_edits():
+    """
+    Verify that repeated queued edits of one note are delivered as its latest state.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"])
+    writer  = api.write_behind(delay=5)
+    note    = test_get_notes()[0]
+    for i in range(3):
+        note.text = "write behind %d" % i
+        writer.edit_note(note)
+    assert_equals(writer.pending, 1)
+    assert_equals(writer.close(), [])
+    assert_equals(test_get_notes()[0].text, "write behind 2")
+
+def test_budget_exceeded():
+    """
+    Verify that a request budget which has run out fails fast with a SnapticError.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'],
+                      url=cfg["host"], retries=2, hedge_after=1.0)
+    assert_true(len(api.get_notes_from_cursor(-1)) > 0)
+    try:
+        with api.budget(0):
+            api.get_tags()
+    except snaptic.SnapticError as e:
+        assert_true("Deadline exceeded" in e.message)
+    else:
+        assert False, "get_tags should have run out of budget"
+
+
+def test_metrics():
+    """
+    Verify that requests are recorded per endpoint and exported in Prometheus format.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    api.get_notes()
+    api.get_tags()
+    snapshot = api.metrics.snapshot()
+    notes    = snapshot['requests']['notes']
+    assert_equals(notes['status'].get(200), notes['count'])
+    assert_true(notes['bytes_in'] > 0)
+    assert_equals(notes['latency']['count'], notes['count'])
+    assert_true('tags' in snapshot['requests'])
+    assert_true('notes' in snapshot['json_parse'])
+    text = api.metrics.prometheus()
+    assert_true('snaptic_requests_total{endpoint="tags",status="200"} 1' in text)
+    assert_true('snaptic_request_duration_seconds_bucket{endpoint="notes",le="+Inf"}' in text)
+
+def test_compressed_responses():
+    """
+    Verify that compressed and uncompressed responses decode to the same notes.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    plain = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"], compression=False)
+    assert_equals(json.loads(api.json_cursor(-1)), json.loads(plain.json_cursor(-1)))
+    assert_equals([n.note_id for n in api.stream_notes(-1)], [n.note_id for n in plain.stream_notes(-1)])
+
+def test_json_backend_parity():
+    """
+    Verify that every installed JSON backend parses the same Note objects.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    api._user = snaptic.User(1, "user", "2010-01-01T00:00:00.000Z", "user@example.com")
+    media = [{"type": "image", "id": 7, "revision_id": 2, "width": 640, "height": 480, "src": "/img/7"}]
+    note  = {"created_at": "c", "modified_at": "m", "reminder_at": None, "text": u"caf\u00e9 #food", "summary": "s",
+             "source": "3banana", "source_url": "https://snaptic.com/", "user": {"id": 1}, "children": 0,
+             "tags": ["food"], "location": {"latitude": 53.3, "longitude": -6.2}, "media": media}
+    source = json.dumps({"notes": [dict(note, id=1), dict(note, id=2, media=[])]})
+    fields = ("note_id", "created_at", "modified_at", "reminder_at", "text", "summary", "source",
+              "source_url", "user", "children", "tags", "location", "has_media")
+    default = snaptic.json_backend
+    parsed  = {}
+    try:
+        for backend in snaptic.JSON_BACKENDS:
+            try:
+                snaptic.set_json_backend(backend)
+            except snaptic.SnapticError:
+                continue
+            notes = api._parse_notes(source)
+            parsed[backend] = [[getattr(n, f) for f in fields] +
+                               [[(i.type, i.id, i.revision_id, i.width, i.height, i.src) for i in n.media]]
+                               for n in notes]
+    finally:
+        snaptic.set_json_backend(default)
+    assert_true('json' in parsed)
+    for backend, notes in parsed.items():
+        assert_equals(notes, parsed['json'])
+
+def test_get_page():
+    """
+    Verify that a page holds notes and cursor information and is served from the page cache.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"],
+                      page_cache=snaptic.PageCache())
+    page = api.get_page(-1)
+    assert_true(len(page.notes) > 0)
+    assert_equals(page.cursor_information, api.get_cursor_information(-1))
+    assert_true(api.get_page(-1) is page)
+    assert_true(api.get_page(-1, refresh=True) is not page)
+
+def test_concurrent_notes_share_one_request():
+    """
+    Verify that threads missing the notes cache at once all get the same list from one request.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(api.notes)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equals(len(results), 8)
+    assert_true(len(results[0]) > 0)
+    assert_true(api.metrics.snapshot()['requests']['notes']['count'] < 8)
+
+def test_account_pool_sync():
+    """
+    Verify that an AccountPool streams one result per account and walks cursor pages in order.
+    """
+    cfg  = config["api"]
+    pool = snaptic.AccountPool(url=cfg["host"], workers=4)
+    pool.add_account("basic", cfg['email'], cfg['password'])
+    pool.add_account("again", cfg['email'], cfg['password'])
+    results = list(pool.sync())
+    assert_equals(sorted(key for key, notes, error in results), ["again", "basic"])
+    assert_true(all(error is None and len(notes) > 0 for key, notes, error in results))
+    pages = [page for key, page, error in pool.walk(keys=["basic"])]
+    assert_equals(pages[0].cursor_position, -1)
+    assert_equals(sum(len(page) for page in pages), len(results[0][1]))
+    pool.close()
+
+def test_rate_limiter_backs_off_and_recovers():
+    """
+    Verify that the rate limiter halves its concurrency on 503 and grows it again on success.
+    """
+    limiter = snaptic.RateLimiter(max_concurrency=16, concurrency=8)
+    limiter.acquire()
+    limiter.release('notes', 503, 0.01)
+    assert_equals(limiter.stats['limit'], 4)
+    assert_equals(limiter.stats['throttled'], 1)
+    for i in range(20):
+        limiter.acquire()
+        limiter.release('notes', 200, 0.01)
+    assert_true(limiter.stats['limit'] > 4)
+    assert_equals(limiter.stats['in_flight'], 0)
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"], rate_limiter=limiter)
+    assert_true(len(api.get_notes_from_cursor(-1)) > 0)
+    assert_equals(limiter.stats['in_flight'], 0)
+
+def test_note_index():
+    """
+    Verify that the note index answers word, prefix and phrase queries and follows writes through the Api.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    index = snaptic.NoteIndex()
+    index.update(api.get_notes())
+    api.add_listener(index)
+    api.post_note("Quokkas are da bomb #zoo")
+    found = index.search('"da bomb" quokk*')
+    assert_equals(len(found), 1)
+    assert_true(found[0].text.startswith("Quokkas"))
+    assert_equals(index.search("quokkas bomb")[0].note_id, found[0].note_id)
+    api.delete_note(found[0].note_id)
+    assert_equals(index.search("quokkas"), [])
+    path = os.path.join(tempfile.mkdtemp(), "notes.idx")
+    index.save(path)
+    assert_equals(len(snaptic.NoteIndex(path)), len(index))
+
+def test_tag_index():
+    """
+    Verify that tag counts are kept locally and follow notes posted and deleted through the Api.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    assert_true(all(isinstance(tag, snaptic.Tag) for tag in api.get_tag_list()))
+    before = api.tag_index.count("zzbulktag")
+    data   = api.post_note("Tag index testing #zzbulktag")
+    note_id = json.loads(data)['notes'][0]['id']
+    assert_equals(api.tag_index.count("zzbulktag"), before + 1)
+    assert_true(note_id in [n.note_id for n in api.get_notes_with_tag("zzbulktag")])
+    api.delete_note(note_id)
+    assert_equals(api.tag_index.count("zzbulktag"), before)
+
+def test_write_through_cache():
+    """
+    Verify that posts, edits and deletes update the cached notes and json without fetching them again.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    count = len(api.notes)
+    assert_equals(len(json.loads(api.json)['notes']), count)
+    fetched = api.metrics.snapshot()['requests']['notes']['count']
+    data    = api.post_note("Write through testing")
+    note    = api.notes[0]
+    assert_equals(note.note_id, json.loads(data)['notes'][0]['id'])
+    note.text = "Write through edited"
+    api.edit_note(note)
+    assert_equals(json.loads(api.json)['notes'][0]['text'], "Write through edited")
+    api.delete_note(note.note_id)
+    assert_equals(len(api.notes), count)
+    assert_true(note.note_id not in [n['id'] for n in json.loads(api.json)['notes']])
+    assert_equals(api.metrics.snapshot()['requests']['notes']['count'], fetched + 2)
+    status = api.cache_status()
+    assert_equals(status['notes']['writes'], 3)
+    assert_true(not status['json']['stale'])
+
+def test_image_cache():
+    """
+    Verify that cached image data is used instead of downloading it and that least recently used images are evicted.
+    """
+    cache = snaptic.ImageCache(tempfile.mkdtemp(), max_bytes=12)
+    cache.set(cache.key(md5="aaaa"), "01234")
+    cache.set(cache.key(id=8, revision_id=1), "56789")
+    cache.set(cache.key(id=8, revision_id=1), "56789")
+    assert_equals(cache.size, 10)
+    os.utime(cache._path(cache.key(md5="aaaa")), (0, 0))
+    cache.set(cache.key(md5="bbbb"), "abcde")
+    assert_equals(cache.get(cache.key(md5="aaaa")), None)
+    assert_equals(cache.get(cache.key(id=8, revision_id=1)), "56789")
+    assert_equals(cache.key(id=8), None)
+    api = snaptic.Api(username="user", password="pass", image_cache=cache)
+    api._user = snaptic.User(1, "user", "2010-01-01T00:00:00.000Z", "user@example.com")
+    media = [{"type": "image", "id": 7, "revision_id": 2, "width": 1, "height": 1, "src": "/img/7", "md5": "bbbb"}]
+    note  = {"id": 1, "created_at": "c", "modified_at": "m", "reminder_at": None, "text": "t", "summary": "s",
+             "source": "3banana", "source_url": "https://snaptic.com/", "user": {"id": 1}, "children": 0,
+             "tags": [], "location": None, "media": media}
+    notes = api._parse_notes(json.dumps({"notes": [note]}), get_image_data=True)
+    assert_equals(notes[0].media[0].data, "abcde")
+    assert_equals(api.get_image_with_id(8, 1), "56789")
+
+def test_bulk_continues_after_unexpected_error():
+    """
+    Verify that an unexpected exception from one item is returned as a SnapticError and the other items still run.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    def func(item):
+        if item == 2:
+            raise KeyError(item)
+        return item
+    results = api._bulk(func, [1, 2, 3], workers=1)
+    assert_equals(results[0], 1)
+    assert_true(isinstance(results[1], snaptic.SnapticError))
+    assert_equals(results[2], 3)
+
+def test_write_behind_records_unexpected_errors():
+    """
+    Verify that an unexpected exception from a queued write is reported as a failure and doesn't stop the worker.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    def post_note(text):
+        if text == "bad":
+            raise KeyError(text)
+    api.post_note = post_note
+    writer = api.write_behind(delay=0)
+    writer.post_note("bad")
+    writer.post_note("good")
+    failures = writer.close(timeout=5)
+    assert_equals([note for note, error in failures], ["bad"])
+    assert_true(isinstance(failures[0][1], snaptic.SnapticError))
+
+def test_async_get_page_and_tag_list():
+    """
+    Verify that AsyncApi returns pages and tags as AsyncResults matching Api.
+    """
+    cfg = config["api"]
+    api = snaptic.AsyncApi(username=cfg['email'], password=cfg['password'],
+                           url=cfg["host"])
+    page = api.get_page(-1).result()
+    assert_equals([n.note_id for n in page.notes], [n.note_id for n in api.get_notes_from_cursor(-1).result()])
+    assert_equals(page.cursor_information, api.get_cursor_information(-1).result())
+    assert_true(all(isinstance(tag, snaptic.Tag) for tag in api.get_tag_list().result()))
+
+def test_write_behind_does_not_retry_posts():
+    """
+    Verify that a queued post failing with a network error is reported without being sent again.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    calls = []
+    def post_note(text):
+        calls.append(text)
+        raise socket.timeout("timed out")
+    api.post_note = post_note
+    writer = api.write_behind(delay=0, retries=2)
+    writer.post_note("once")
+    assert_equals([note for note, error in writer.close(timeout=5)], ["once"])
+    assert_equals(calls, ["once"])
+
+def test_load_image_leaves_caller_file_open():
+    """
+    Verify that loading an image from a file object returns the response and leaves the file open.
+    """
+    api = snaptic.Api(username="user", password="pass")
+    api.add_image_to_note_with_id = lambda filename, data, id: data.read()
+    fin = tempfile.TemporaryFile()
+    fin.write("image data")
+    fin.seek(0)
+    assert_equals(api.load_image_and_add_to_note_with_id(fin, 1), "image data")
+    assert_true(not fin.closed)
+
+def test_tag_index_keeps_notes_lazy():
+    """
+    Verify that the tag index follows get_notes(lazy=True) without building every note.
+    """
+    cfg = config["api"]
+    api = snaptic.Api(username=cfg['email'], password=cfg['password'], url=cfg["host"])
+    tags  = api.tags
+    notes = api.get_notes(lazy=True)
+    assert_true(repr(notes).endswith(" 0 built>"))
+    assert_equals(api.tags, tags)
+    if tags:
+        assert_equals(len(api.get_notes_with_tag(tags[0].name)), tags[0].count)